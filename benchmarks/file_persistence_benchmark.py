@@ -0,0 +1,49 @@
+"""
+Measures save and load latency of the file persistence plugin for each state format as the state grows.
+
+    python -m benchmarks.file_persistence_benchmark
+"""
+import os
+import time
+
+from tests.environment import prepare_environment
+from .state_generator import generate_state
+
+SIZES = [100, 1000, 10000]
+REPETITIONS = 5
+
+
+def _measure(func):
+    durations = []
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def run():
+    directory = prepare_environment()
+    from opsbot.config import reload_config
+    from opsbot.plugins.persistence import file
+    from opsbot.plugins.persistence.file import FilePersistencePlugin
+
+    print(f"{'users':>6} | {'format':<8} | {'size [KiB]':>10} | {'save [ms]':>9} | {'load [ms]':>9}")
+    for size in SIZES:
+        state = generate_state(users=size, vacations=size // 2, issues=size // 2)
+        for format_name in file.FORMATS:
+            if format_name == 'msgpack' and file.msgpack is None:
+                print(f"{size:>6} | {format_name:<8} | msgpack is not installed")
+                continue
+            os.environ['PERSISTENCE_PATH'] = os.path.join(directory, f"state.{format_name}")
+            os.environ['PERSISTENCE_FORMAT'] = format_name
+            reload_config()
+            plugin = FilePersistencePlugin(None)
+            save = _measure(lambda: plugin.persist_state(state))
+            load = _measure(plugin.read_state)
+            size_kib = os.path.getsize(os.environ['PERSISTENCE_PATH']) / 1024
+            print(f"{size:>6} | {format_name:<8} | {size_kib:>10.1f} | {save * 1000:>9.2f} | {load * 1000:>9.2f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,190 @@
+"""
+Load test for the persistence plugins. For each backend and state size it measures
+ - read_state and persist_state of the whole state,
+ - updates through the StateManager, the path save_plugin_variable and the bot_config saves take, with several
+   concurrent writers and every update written immediately,
+and reports latency percentiles, the bytes written per update and the peak memory of a read, a full write and
+the updates of one writer. The configmap plugin runs against an in-memory fake of the Kubernetes API.
+
+    python -m benchmarks.persistence_benchmark
+"""
+import os
+import random
+import threading
+import time
+import tracemalloc
+
+from tests.environment import prepare_environment
+from .state_generator import generate_state
+
+SIZES = [100, 1000, 5000]
+REPETITIONS = 10
+WRITERS = 4
+UPDATES_PER_WRITER = 20
+
+BACKENDS = {
+    'file yaml': dict(plugin='file', format='yaml'),
+    'file json': dict(plugin='file', format='json'),
+    'file msgpack': dict(plugin='file', format='msgpack'),
+    'file journal': dict(plugin='file', format='json', journal='true'),
+    'sqlite': dict(plugin='sqlite'),
+    'configmap': dict(plugin='configmap'),
+    'configmap gzip': dict(plugin='configmap', compress='true'),
+}
+
+
+def _percentile(ordered, fraction):
+    """Interpolates between the closest ranks, like statistics.quantiles(method='inclusive') of Python 3.8"""
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def _percentiles(durations):
+    ordered = sorted(durations)
+    return [_percentile(ordered, fraction) * 1000 for fraction in (0.5, 0.95, 0.99)]
+
+
+def _measure(func, repetitions=REPETITIONS):
+    durations = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _bytes_written():
+    """Bytes this process passed to write syscalls. Only available on Linux."""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class _Backend(object):
+
+    def __init__(self, name, settings, directory):
+        self.name = name
+        self._settings = settings
+        self._directory = directory
+        self.api = None
+
+    def available(self):
+        if self._settings.get('format') == 'msgpack':
+            from opsbot.plugins.persistence import file
+            return file.msgpack is not None
+        return True
+
+    def create(self):
+        """Creates a plugin with an empty store."""
+        from opsbot.config import reload_config
+        for key in ('PERSISTENCE_PATH', 'PERSISTENCE_FORMAT', 'PERSISTENCE_JOURNAL', 'PERSISTENCE_COMPRESS',
+                    'PERSISTENCE_CONFIGMAP_NAME', 'PERSISTENCE_CONFIGMAP_NAMESPACE'):
+            os.environ.pop(key, None)
+        for key, value in self._settings.items():
+            if key != 'plugin':
+                os.environ[f"PERSISTENCE_{key.upper()}"] = value
+        plugin = self._settings['plugin']
+        if plugin == 'configmap':
+            from tests.fake_kubernetes import FakeConfigmapPersistencePlugin, FakeCoreV1Api
+            os.environ['PERSISTENCE_CONFIGMAP_NAME'] = 'opsbot'
+            os.environ['PERSISTENCE_CONFIGMAP_NAMESPACE'] = 'benchmark'
+            reload_config()
+            self.api = FakeCoreV1Api()
+            instance = FakeConfigmapPersistencePlugin(None, self.api)
+            instance.read_state()
+            return instance
+        path = os.path.join(self._directory, f"state-{self.name.replace(' ', '-')}")
+        for suffix in ('', '.journal', '.journal.compacting', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        os.environ['PERSISTENCE_PATH'] = path
+        reload_config()
+        if plugin == 'sqlite':
+            from opsbot.plugins.persistence.sqlite import SqlitePersistencePlugin
+            return SqlitePersistencePlugin(None)
+        from opsbot.plugins.persistence.file import FilePersistencePlugin
+        return FilePersistencePlugin(None)
+
+    def bytes_written(self):
+        return _bytes_written() + (self.api.bytes_received if self.api else 0)
+
+
+def _writer(manager, writer, durations):
+    """Applies the updates handlers typically make: new users, new vacations and a changed list of Jira issues."""
+    rng = random.Random(writer)
+    for i in range(UPDATES_PER_WRITER):
+        kind = rng.randrange(3)
+        start = time.perf_counter()
+        if kind == 0:
+            user = {f"New User {writer}-{i}": f"29:{rng.getrandbits(64):x}"}
+            manager.update(('bot_config', 'user_map'), lambda user_map: dict(user_map, **user), dict())
+        elif kind == 1:
+            vacation = [f"User {i:05d}", "01.01.2021", "05.01.2021"]
+            manager.update(('plugins', 'actions', 'operations', 'vacations'), lambda vacations: vacations + [vacation], list())
+        else:
+            manager.update(('plugins', 'actions', 'jira', 'issues'), lambda issues: issues[1:] + [f"PROJ-{writer}-{i}"], list())
+        durations.append(time.perf_counter() - start)
+
+
+def _run_writers(manager, writers=WRITERS):
+    durations = []
+    threads = [threading.Thread(target=_writer, args=(manager, writer, durations)) for writer in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manager.flush()
+    return durations
+
+
+def _peak_memory(backend, state):
+    from opsbot.state_manager import StateManager
+    plugin = backend.create()
+    plugin.persist_state(state)
+    tracemalloc.start()
+    loaded = plugin.read_state()
+    plugin.persist_state(loaded)
+    _run_writers(StateManager(plugin, loaded, debounce=0), writers=1)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def run():
+    directory = prepare_environment()
+    from opsbot.state_manager import StateManager
+
+    print(f"{'backend':<14} | {'users':>5} | {'read p50/p95/p99 [ms]':>23} | {'write p50/p95/p99 [ms]':>23} | "
+          f"{'update p50/p95/p99 [ms]':>23} | {'KiB/update':>10} | {'peak [MiB]':>10}")
+    for size in SIZES:
+        state = generate_state(users=size, vacations=size // 2, issues=size // 2)
+        for name, settings in BACKENDS.items():
+            backend = _Backend(name, settings, directory)
+            if not backend.available():
+                print(f"{name:<14} | {size:>5} | not available")
+                continue
+            plugin = backend.create()
+            write = _percentiles(_measure(lambda: plugin.persist_state(state)))
+            read = _percentiles(_measure(plugin.read_state))
+
+            loaded = plugin.read_state()
+            manager = StateManager(plugin, loaded, debounce=0)
+            bytes_before = backend.bytes_written()
+            update = _percentiles(_run_writers(manager))
+            kib_per_update = (backend.bytes_written() - bytes_before) / (WRITERS * UPDATES_PER_WRITER) / 1024
+
+            peak = _peak_memory(backend, state) / 1024 / 1024
+            print(f"{name:<14} | {size:>5} | {'/'.join(f'{v:.2f}' for v in read):>23} | "
+                  f"{'/'.join(f'{v:.2f}' for v in write):>23} | {'/'.join(f'{v:.2f}' for v in update):>23} | "
+                  f"{kib_per_update:>10.1f} | {peak:>10.1f}", flush=True)
+
+
+if __name__ == "__main__":
+    run()
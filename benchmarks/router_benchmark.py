@@ -0,0 +1,46 @@
+"""
+Compares message dispatch of the command router with the former linear scan over all message hooks.
+
+    python -m benchmarks.router_benchmark
+"""
+import re
+import timeit
+
+from opsbot.router import CommandRouter
+
+COMMAND_COUNTS = [10, 100, 1000]
+REPETITIONS = 2000
+
+
+def _linear_find(hooks, text):
+    for matcher, func in hooks:
+        if matcher.findall(text.lower()):
+            return func
+    return None
+
+
+def _messages(count):
+    return {
+        "first command": f"<at>OpsBot</at> command0 argument",
+        "last command": f"<at>OpsBot</at> command{count - 1} argument",
+        "unknown command": "<at>OpsBot</at> does not exist",
+    }
+
+
+def run():
+    print(f"{'commands':>8} | {'message':<16} | {'linear [us]':>11} | {'router [us]':>11}")
+    for count in COMMAND_COUNTS:
+        patterns = [rf"command{i}\s+(\w+)" for i in range(count)]
+        linear_hooks = [(re.compile(pattern), pattern) for pattern in patterns]
+        router = CommandRouter()
+        for pattern in patterns:
+            router.add_regex(pattern, pattern)
+        for name, text in _messages(count).items():
+            assert _linear_find(linear_hooks, text) == router.find(text)
+            linear = timeit.timeit(lambda: _linear_find(linear_hooks, text), number=REPETITIONS) / REPETITIONS
+            routed = timeit.timeit(lambda: router.find(text), number=REPETITIONS) / REPETITIONS
+            print(f"{count:>8} | {name:<16} | {linear * 1e6:>11.2f} | {routed * 1e6:>11.2f}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,58 @@
+"""
+Compares plugin discovery which imports every plugin module with the discovery which only imports the configured
+persistence plugin and the active action plugins. Each run happens in a fresh interpreter, so imports are cold.
+Reports the discovery time, the peak RSS of the process and whether the kubernetes client was imported.
+
+    python -m benchmarks.startup_benchmark
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from tests.environment import prepare_environment
+
+REPETITIONS = 5
+PLUGIN_TYPES = ['actions', 'persistence', 'leader_election']
+
+_DISCOVERY = """
+import json, resource, sys, time
+start = time.perf_counter()
+from opsbot.plugins import plugin_loader
+from opsbot.plugins.actions import ActionPlugin
+from opsbot.plugins.leader_election import LeaderElectionPlugin
+from opsbot.plugins.persistence import PersistencePlugin
+base_classes = dict(actions=ActionPlugin, persistence=PersistencePlugin, leader_election=LeaderElectionPlugin)
+for plugin_type in {plugin_types!r}:
+    names = None if {eager!r} else plugin_loader._active_plugin_names(plugin_type)
+    plugin_loader._find_plugin_classes(plugin_type, base_classes[plugin_type], names)
+duration = time.perf_counter() - start
+print(json.dumps(dict(duration=duration, rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      kubernetes='kubernetes' in sys.modules)))
+"""
+
+
+def _measure(eager):
+    code = _DISCOVERY.format(plugin_types=PLUGIN_TYPES, eager=eager)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = []
+    for _ in range(REPETITIONS):
+        output = subprocess.run([sys.executable, "-c", code], cwd=root, env=os.environ, check=True,
+                                capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def run():
+    prepare_environment()
+    print(f"{'discovery':<10} | {'time [ms]':>9} | {'peak RSS [MiB]':>14} | kubernetes imported")
+    for name, eager in (("all", True), ("active", False)):
+        results = _measure(eager)
+        duration = statistics.median(r['duration'] for r in results) * 1000
+        rss = statistics.median(r['rss'] for r in results) / 1024
+        print(f"{name:<10} | {duration:>9.1f} | {rss:>14.1f} | {results[0]['kubernetes']}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,46 @@
+import random
+import string
+from datetime import date, timedelta
+
+
+def _random_id(prefix, length=40):
+    return prefix + "".join(random.choices(string.ascii_letters + string.digits + "-_", k=length))
+
+
+def generate_state(users=1000, vacations=500, issues=500, seed=42):
+    """Generates bot state shaped like a long running production instance."""
+    random.seed(seed)
+    names = [f"User {i:05d}" for i in range(users)]
+    start = date(2020, 1, 1)
+    vacation_list = []
+    for i in range(vacations):
+        begin = start + timedelta(days=random.randint(0, 1000))
+        end = begin + timedelta(days=random.randint(0, 14))
+        vacation_list.append([random.choice(names), begin.strftime("%d.%m.%Y"), end.strftime("%d.%m.%Y")])
+    return {
+        "bot_config": {
+            "service_url": "https://smba.trafficmanager.net/emea/",
+            "conversations": {},
+            "current_channel": "msteams",
+            "current_bot_id": {"id": _random_id("28:"), "name": "OpsBot"},
+            "channel_data": {"channel": {"id": _random_id("19:")}, "tenant": {"id": _random_id("")}},
+            "user_map": {name: _random_id("29:") for name in names},
+            "conversation_channels": {"defects": _random_id("19:"), "alerts": _random_id("19:")},
+        },
+        "plugins": {
+            "actions": {
+                "operations": {
+                    "members": {"index": 3, "elements": names[:50]},
+                    "vacations": vacation_list,
+                    "override": None,
+                    "sayings_responsible_today": {"index": 1},
+                },
+                "sayings": {"sayings_state": {"index": 7}},
+                "jira": {
+                    "last_check": 1600000000.0,
+                    "issues": [f"PROJ-{i}" for i in range(issues)],
+                },
+                "reminders": {"latest_reminder_run": "2020-03-11"},
+            }
+        }
+    }
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+from urllib.parse import quote
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+from . import metrics
+
+logger = logging.getLogger()
+
+
+class TeamsApiError(Exception):
+    """Failed send. Exposes the response like msrest's HttpOperationError so the outbound queue can retry it."""
+
+    def __init__(self, status, headers, text):
+        super().__init__(f"Teams API responded with {status}: {text}")
+        self.response = SimpleNamespace(status_code=status, headers=headers)
+
+
+class AiohttpServer(object):
+    """
+    Asyncio based server for the bot. Incoming webhooks are served on the event loop, the synchronous plugin
+    handlers still run on the handler pool of the bot. Outbound messages to Teams are sent with a shared
+    aiohttp client session on the same loop.
+    """
+
+    def __init__(self, bot, request_timeout=30):
+        self._bot = bot
+        self._request_timeout = request_timeout
+        self._loop = None
+        self._session = None
+        self._app = web.Application()
+        self._app.add_routes([
+            web.post('/api/message', self.message_received),
+            web.get('/health', self.health),
+            web.get('/metrics', self.metrics_page),
+            web.get('/', self.index_page),
+        ])
+        self._app.on_startup.append(self._on_startup)
+        self._app.on_cleanup.append(self._on_cleanup)
+
+    async def _on_startup(self, app):
+        self._loop = asyncio.get_event_loop()
+        self._session = ClientSession(timeout=ClientTimeout(total=self._request_timeout))
+        self._bot.set_send_transport(self._send_activity)
+
+    async def _on_cleanup(self, app):
+        self._bot.set_send_transport(None)
+        await self._session.close()
+
+    async def message_received(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            body = None
+        # Authentication might have to fetch signing keys on a cold cache, so keep it off the event loop
+        status = await self._loop.run_in_executor(None, self._bot.accept_activity, body, request.headers.get("Authorization"))
+        return web.Response(status=status, text="")
+
+    async def health(self, request):
+        return web.Response(text=self._bot.health())
+
+    async def metrics_page(self, request):
+        content, content_type = metrics.exposition()
+        # aiohttp does not accept the charset as part of content_type
+        return web.Response(body=content, headers={"Content-Type": content_type})
+
+    async def index_page(self, request):
+        return web.Response(text=self._bot.index_page())
+
+    def _send_activity(self, conversation_id, activity):
+        """Called by the outbound queue workers. Runs the request on the event loop and waits for the result."""
+        token = self._bot.connector_credentials().get_access_token()
+        future = asyncio.run_coroutine_threadsafe(self._post_activity(conversation_id, activity, token), self._loop)
+        return future.result()
+
+    async def _post_activity(self, conversation_id, activity, token):
+        url = f"{activity.service_url.rstrip('/')}/v3/conversations/{quote(conversation_id, safe='')}/activities"
+        headers = {"Authorization": f"Bearer {token}"}
+        async with self._session.post(url, json=activity.serialize(), headers=headers) as response:
+            if response.status >= 300:
+                raise TeamsApiError(response.status, response.headers, await response.text())
+            result = await response.json(content_type=None)
+            logger.info(result)
+            return result
+
+    def run(self, port=5000):
+        web.run_app(self._app, host='0.0.0.0', port=port, access_log=None)
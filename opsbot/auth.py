@@ -0,0 +1,124 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+import requests
+from botframework.connector.auth import AuthenticationConstants
+from jwt.algorithms import RSAAlgorithm
+
+logger = logging.getLogger()
+
+SERVICE_URL_CLAIM = "serviceurl"
+CLOCK_TOLERANCE_SECONDS = 5 * 60
+
+
+class AuthenticationError(Exception):
+    pass
+
+
+class TokenValidator(object):
+    """
+    Validates the JWT bearer tokens the bot framework channel sends with every activity.
+    The OpenID metadata and signing keys are cached and refreshed in the background, and tokens which were
+    validated once are remembered until they expire, so a warm request only costs a few dictionary lookups.
+    """
+
+    def __init__(self, app_id, metadata_url=AuthenticationConstants.TO_BOT_FROM_CHANNEL_OPEN_ID_METADATA_URL,
+                 metadata_ttl=24 * 60 * 60, token_cache_size=1000, request_timeout=10):
+        self._app_id = app_id
+        self._metadata_url = metadata_url
+        self._metadata_ttl = metadata_ttl
+        self._token_cache_size = token_cache_size
+        self._request_timeout = request_timeout
+        self._session = requests.Session()
+        self._keys = dict()
+        self._keys_fetched_at = 0
+        self._refresh_lock = threading.Lock()
+        self._validated_tokens = OrderedDict()
+        self._validated_tokens_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._refresh_thread = threading.Thread(target=self._refresh_periodically, name="jwks-refresh", daemon=True)
+
+    def start(self):
+        self._refresh_thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def validate(self, authorization, activity):
+        """Raises an AuthenticationError if the authorization header is not valid for the activity."""
+        if not authorization or not authorization.startswith("Bearer "):
+            raise AuthenticationError("Missing bearer token")
+        token = authorization[len("Bearer "):]
+        claims, endorsements = self._cached_token(token) or self._validate_token(token)
+        if activity.channel_id and activity.channel_id not in (endorsements or ()):
+            raise AuthenticationError(f"Signing key is not endorsed for channel '{activity.channel_id}'")
+        if claims.get(SERVICE_URL_CLAIM) != activity.service_url:
+            raise AuthenticationError("Service url of the activity does not match the token")
+
+    def _cached_token(self, token):
+        with self._validated_tokens_lock:
+            entry = self._validated_tokens.get(token)
+            if not entry:
+                return None
+            claims, endorsements = entry
+            if claims["exp"] + CLOCK_TOLERANCE_SECONDS < time.time():
+                del self._validated_tokens[token]
+                return None
+            self._validated_tokens.move_to_end(token)
+            return entry
+
+    def _validate_token(self, token):
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.InvalidTokenError as e:
+            raise AuthenticationError(f"Invalid token: {str(e)}")
+        if header.get("alg") not in AuthenticationConstants.ALLOWED_SIGNING_ALGORITHMS:
+            raise AuthenticationError(f"Token signing algorithm '{header.get('alg')}' is not allowed")
+        public_key, endorsements = self._signing_key(header.get("kid"))
+        try:
+            claims = jwt.decode(token, public_key, algorithms=AuthenticationConstants.ALLOWED_SIGNING_ALGORITHMS,
+                                audience=self._app_id, issuer=AuthenticationConstants.TO_BOT_FROM_CHANNEL_TOKEN_ISSUER,
+                                leeway=CLOCK_TOLERANCE_SECONDS, options=dict(require_exp=True))
+        except jwt.InvalidTokenError as e:
+            raise AuthenticationError(f"Invalid token: {str(e)}")
+        with self._validated_tokens_lock:
+            self._validated_tokens[token] = (claims, endorsements)
+            while len(self._validated_tokens) > self._token_cache_size:
+                self._validated_tokens.popitem(last=False)
+        return claims, endorsements
+
+    def _signing_key(self, key_id):
+        if key_id not in self._keys and time.time() - self._keys_fetched_at > CLOCK_TOLERANCE_SECONDS:
+            # Unknown key: the keys might have been rotated since the last refresh
+            self._refresh_keys()
+        if key_id not in self._keys:
+            raise AuthenticationError(f"Unknown signing key '{key_id}'")
+        return self._keys[key_id]
+
+    def _refresh_keys(self):
+        with self._refresh_lock:
+            response = self._session.get(self._metadata_url, timeout=self._request_timeout)
+            response.raise_for_status()
+            jwks_uri = response.json()["jwks_uri"]
+            response = self._session.get(jwks_uri, timeout=self._request_timeout)
+            response.raise_for_status()
+            keys = dict()
+            for key in response.json()["keys"]:
+                keys[key["kid"]] = (RSAAlgorithm.from_jwk(json.dumps(key)), key.get("endorsements", []))
+            self._keys = keys
+            self._keys_fetched_at = time.time()
+            logger.info(f"Loaded {len(keys)} signing keys from '{jwks_uri}'")
+
+    def _refresh_periodically(self):
+        interval = 0
+        while not self._stopped.wait(interval):
+            try:
+                self._refresh_keys()
+                interval = self._metadata_ttl
+            except Exception as e:
+                logger.warning(f"Could not refresh signing keys: {str(e)}")
+                interval = 60
@@ -1,6 +1,10 @@
+import copy
 import logging
 import os
 import sys
+import threading
+from types import MappingProxyType
+from typing import Dict, List, Optional
 
 import oyaml
 
@@ -8,35 +12,151 @@ from .constants import OPSBOT_CONFIG_FILE_ENV, OPSBOT_CONFIG_FILE_DEFAULT
 
 logger = logging.getLogger()
 
-_config = None
+_MISSING = object()
+_TRUE_VALUES = {'y', 'yes', 't', 'true', 'on', '1'}
+_FALSE_VALUES = {'n', 'no', 'f', 'false', 'off', '0'}
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def config_file_path():
+    return os.environ.get(OPSBOT_CONFIG_FILE_ENV, OPSBOT_CONFIG_FILE_DEFAULT)
+
+
+def _read_config_file(path):
+    with open(path) as f:
+        return oyaml.safe_load(f.read())
 
 
 def _load_config():
-    path = os.environ.get(OPSBOT_CONFIG_FILE_ENV, OPSBOT_CONFIG_FILE_DEFAULT)
+    path = config_file_path()
     if not os.path.exists(path):
         logger.critical(f"Opsbot config file not found at path: '{path}'")
         sys.exit(-1)
+    return _read_config_file(path)
 
-    with open(path) as f:
-        return oyaml.safe_load(f.read())
+
+def _env_name(key):
+    return key.replace('.', '_').upper()
+
+
+def _flatten(config, prefix, values):
+    for key, value in config.items():
+        path = f"{prefix}{key}"
+        values[path] = value
+        if isinstance(value, dict):
+            _flatten(value, f"{path}.", values)
+
+
+def _convert(key, value, convert, type_name):
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        logger.critical(f"Configuration '{key}' must be {type_name}, got '{value}'")
+        exit(-1)
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    normalized = str(value).strip().lower()
+    if normalized in _TRUE_VALUES:
+        return True
+    if normalized in _FALSE_VALUES:
+        return False
+    raise ValueError(f"invalid truth value '{value}'")
+
+
+def _copy(value):
+    """Nested dicts and lists are copied, so callers can not change the snapshot"""
+    return copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+
+
+def _to_list(value):
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(',') if item.strip()]
+    return list(value)
 
 
-def _get_config_value_from_yaml(key):
-    global _config
-    if not _config:
-        _config = _load_config()
+class ConfigSnapshot(object):
+    """
+    Immutable view of the opsbot config. Every key of the config file is stored under its dotted path, so a lookup
+    is a single dictionary access. Dict and list values are returned as copies. Environment variables (the key in
+    upper case with underscores, e.g. TEAMS_APP_ID) override the file. Only missing keys (None) fall back to the
+    default, so 0, False or an empty list can be configured.
+    """
+
+    def __init__(self, config: Optional[Dict], environ):
+        values = dict()
+        _flatten(config or dict(), "", values)
+        self._environ = {name: value for name, value in environ.items() if value}
+        for key in values:
+            override = self._environ.get(_env_name(key))
+            if override is not None:
+                values[key] = override
+        self._values = MappingProxyType(values)
+        self._env_lookups = dict()
+
+    def _lookup(self, key):
+        value = self._values.get(key)
+        if value is not None:
+            return value
+        # Keys which are not in the config file can still be set in the environment
+        value = self._env_lookups.get(key, _MISSING)
+        if value is _MISSING:
+            value = self._env_lookups[key] = self._environ.get(_env_name(key))
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is None else _copy(value)
+
+    def get_int(self, key, default=None) -> Optional[int]:
+        value = self._lookup(key)
+        return default if value is None else _convert(key, value, int, "an integer")
 
-    ptr = _config
-    for var in key.split('.'):
-        if ptr and var in ptr:
-            ptr = ptr[var]
-        else:
-            return None
-    return ptr
+    def get_float(self, key, default=None) -> Optional[float]:
+        value = self._lookup(key)
+        return default if value is None else _convert(key, value, float, "a number")
 
+    def get_bool(self, key, default=False) -> bool:
+        value = self._lookup(key)
+        return default if value is None else _convert(key, value, _to_bool, "a boolean")
 
-def _get_config_value_from_env(key):
-    return os.environ.get(key.replace('.', '_').upper())
+    def get_list(self, key, default=None) -> List:
+        value = self._lookup(key)
+        if value is None:
+            return list() if default is None else default
+        return _convert(key, _copy(value), _to_list, "a list")
+
+    def missing(self, keys) -> List[str]:
+        return [key for key in keys if self._lookup(key) is None]
+
+
+def get_config() -> ConfigSnapshot:
+    """Returns the current config snapshot. The config file is read on first use."""
+    global _snapshot
+    if _snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = ConfigSnapshot(_load_config(), os.environ)
+    return _snapshot
+
+
+def reload_config() -> ConfigSnapshot:
+    """
+    Reads the config file and the environment again and replaces the current snapshot. Raises an exception instead
+    of exiting if the file is missing, empty or invalid, e.g. while it is being replaced, so the current snapshot stays.
+    """
+    global _snapshot
+    config = _read_config_file(config_file_path())
+    if not config:
+        raise ValueError("The config file is empty")
+    snapshot = ConfigSnapshot(config, os.environ)
+    with _snapshot_lock:
+        _snapshot = snapshot
+    return snapshot
 
 
 def get_config_value(key, default=None, fail_if_missing=False):
@@ -47,12 +167,24 @@ def get_config_value(key, default=None, fail_if_missing=False):
     :param fail_if_missing: If true and key is missing in config, log error and exit app.
     :return: the configured value or None.
     """
-    value = _get_config_value_from_env(key)
-    if not value:
-        value = _get_config_value_from_yaml(key)
-    if not value:
-        value = default
-    if not value and fail_if_missing:
+    value = get_config().get(key, default)
+    if value is None and fail_if_missing:
         logger.critical(f"Required configuration '{key}' is missing.")
         exit(-1)
     return value
+
+
+def get_config_int(key, default=None) -> Optional[int]:
+    return get_config().get_int(key, default)
+
+
+def get_config_float(key, default=None) -> Optional[float]:
+    return get_config().get_float(key, default)
+
+
+def get_config_bool(key, default=False) -> bool:
+    return get_config().get_bool(key, default)
+
+
+def get_config_list(key, default=None) -> List:
+    return get_config().get_list(key, default)
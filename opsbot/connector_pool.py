@@ -0,0 +1,93 @@
+import base64
+import json
+import logging
+import threading
+import time
+
+from botframework.connector import ConnectorClient
+from botframework.connector.auth import MicrosoftAppCredentials
+
+logger = logging.getLogger()
+
+TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+DEFAULT_TOKEN_LIFETIME_SECONDS = 60 * 60
+
+
+def _token_expiry(token):
+    """Reads the 'exp' claim of a JWT without validating it. Falls back to a default lifetime."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return time.time() + DEFAULT_TOKEN_LIFETIME_SECONDS
+
+
+class CachingAppCredentials(MicrosoftAppCredentials):
+    """
+    App credentials which keep the current OAuth token in memory and only fetch a new one shortly before it expires.
+    """
+
+    def __init__(self, app_id, password, refresh_margin=TOKEN_REFRESH_MARGIN_SECONDS):
+        super().__init__(app_id, password)
+        self._refresh_margin = refresh_margin
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+        self.token_refreshes = 0
+
+    def get_access_token(self, force_refresh: bool = False) -> str:
+        with self._token_lock:
+            if force_refresh or not self._token or time.time() >= self._token_expires_at - self._refresh_margin:
+                self._token = super().get_access_token(force_refresh)
+                self._token_expires_at = _token_expiry(self._token)
+                self.token_refreshes += 1
+                logger.debug(f"Fetched new bot framework token, valid until {self._token_expires_at}")
+            return self._token
+
+
+class ConnectorPool(object):
+    """
+    Long-lived bot framework connectors keyed by service url. The connectors keep their HTTP session open
+    and share one set of token caching credentials.
+    """
+
+    def __init__(self, app_id, app_password):
+        self._credentials = CachingAppCredentials(app_id, app_password)
+        self._connectors = dict()
+        self._lock = threading.Lock()
+        self._connections_created = 0
+        self._connections_reused = 0
+
+    def get(self, service_url) -> ConnectorClient:
+        with self._lock:
+            connector = self._connectors.get(service_url)
+            if connector:
+                self._connections_reused += 1
+                return connector
+            connector = ConnectorClient(self._credentials, base_url=service_url)
+            connector.config.keep_alive = True
+            self._connectors[service_url] = connector
+            self._connections_created += 1
+            logger.info(f"Created connector for service url '{service_url}'")
+            return connector
+
+    def credentials(self) -> CachingAppCredentials:
+        return self._credentials
+
+    def stats(self):
+        return dict(
+            connectors=len(self._connectors),
+            connections_created=self._connections_created,
+            connections_reused=self._connections_reused,
+            token_refreshes=self._credentials.token_refreshes,
+        )
+
+    def close(self):
+        with self._lock:
+            for connector in self._connectors.values():
+                try:
+                    connector.close()
+                except Exception:
+                    logger.exception("Error while closing connector")
+            self._connectors.clear()
@@ -0,0 +1,69 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+
+class HandlerPool(object):
+    """
+    Runs message handlers on a bounded number of worker threads. At most max_queue handlers wait for a free worker,
+    further submissions are rejected so the caller can shed load. Handlers running longer than the timeout are
+    reported through the on_timeout callback. Python threads can not be cancelled, so the handler itself keeps running.
+    A timeout given to submit overrides the default timeout of the pool for that handler.
+    """
+
+    def __init__(self, max_workers=8, max_queue=100, timeout=120.0, name="handler"):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._timeout = timeout
+        self._stats_lock = threading.Lock()
+        self._accepted = 0
+        self._rejected = 0
+        self._timed_out = 0
+
+    def submit(self, func, *args, on_timeout=None, timeout=None) -> bool:
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self._rejected += 1
+            return False
+        with self._stats_lock:
+            self._accepted += 1
+        try:
+            self._executor.submit(self._run, func, args, on_timeout, timeout or self._timeout)
+        except RuntimeError:
+            self._slots.release()
+            return False
+        return True
+
+    def _run(self, func, args, on_timeout, timeout):
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self._timed_out_callback, args=(func, on_timeout, timeout))
+            timer.daemon = True
+            timer.start()
+        try:
+            func(*args)
+        except Exception:
+            logger.exception(f"Handler '{getattr(func, '__name__', func)}' failed")
+        finally:
+            if timer:
+                timer.cancel()
+            self._slots.release()
+
+    def _timed_out_callback(self, func, on_timeout, timeout):
+        with self._stats_lock:
+            self._timed_out += 1
+        logger.warning(f"Handler '{getattr(func, '__name__', func)}' is running longer than {timeout}s")
+        if on_timeout:
+            try:
+                on_timeout()
+            except Exception:
+                logger.exception("Timeout callback failed")
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(accepted=self._accepted, rejected=self._rejected, timed_out=self._timed_out)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,52 @@
+import functools
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+COMMAND_DURATION = Histogram('opsbot_command_duration_seconds', 'Duration of message commands', ['plugin', 'command'])
+COMMANDS = Counter('opsbot_commands_total', 'Processed message commands', ['plugin', 'command', 'result'])
+SEND_DURATION = Histogram('opsbot_send_duration_seconds', 'Duration of sending an activity to Teams')
+SENDS = Counter('opsbot_sends_total', 'Attempts to send an activity to Teams', ['result'])
+JOB_DURATION = Histogram('opsbot_job_duration_seconds', 'Duration of scheduled jobs', ['job'])
+JOBS = Counter('opsbot_jobs_total', 'Runs of scheduled jobs', ['job', 'result'])
+JOB_MISFIRES = Counter('opsbot_job_misfires_total', 'Scheduled jobs which missed their run time', ['job'])
+PERSISTENCE_DURATION = Histogram('opsbot_persistence_write_duration_seconds', 'Duration of writing the state', ['plugin'])
+PERSISTENCE_WRITES = Counter('opsbot_persistence_writes_total', 'Writes of the state', ['plugin', 'result'])
+PERSISTENCE_BYTES = Counter('opsbot_persistence_written_bytes_total', 'Bytes written by the persistence plugin', ['plugin'])
+BACKEND_DURATION = Histogram('opsbot_backend_request_duration_seconds',
+                             'Duration of calls to external services like Jira or the alertmanager', ['plugin'])
+BACKEND_REQUESTS = Counter('opsbot_backend_requests_total', 'Calls to external services', ['plugin', 'result'])
+
+
+def instrument(func, duration: Histogram, total: Counter, **labels):
+    """Wraps func so every call is observed in the duration histogram and counted by result (success or error)."""
+    observed = duration.labels(**labels) if labels else duration
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        start = time.perf_counter()
+        result = "error"
+        try:
+            value = func(*args, **kwargs)
+            result = "success"
+            return value
+        finally:
+            observed.observe(time.perf_counter() - start)
+            total.labels(result=result, **labels).inc()
+
+    return run
+
+
+def owner_name(owner):
+    """The label for the owner of a message hook or job: the plugin name or 'opsbot' for the bot itself"""
+    plugin_name = getattr(owner, 'plugin_name', None)
+    return plugin_name() if plugin_name else "opsbot"
+
+
+def job_misfired(event):
+    JOB_MISFIRES.labels(job=event.job_id).inc()
+
+
+def exposition():
+    """Returns the content and the content type of the metrics page"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,17 +1,30 @@
 import atexit
+import functools
+import logging
 import re
 
+from apscheduler.events import EVENT_JOB_MISSED
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.schedulers.background import BackgroundScheduler
 
+from . import metrics
+from .config import config_file_path, get_config, get_config_float, get_config_value, reload_config
 from .teams import TeamsBot
+from .utils.file_watcher import DirectoryWatcher, FileWatcher
+from .utils.time_utils import TIMEZONE
+
+logger = logging.getLogger()
 
 
 class OpsBot(TeamsBot):
     def __init__(self):
         super(OpsBot, self).__init__("opsbot")
         self._scheduler = self._init_scheduler()
+        self._leader_election = self._init_leader_election()
         self._init_hooks()
         self.plugins.init_action_plugins()
+        self._config_watcher = self._init_config_watcher()
+        self._plugin_watcher = self._init_plugin_watcher()
 
     def _init_hooks(self):
         self.register_messagehook_regex(r".*help.*", self.help)
@@ -23,9 +36,10 @@ class OpsBot(TeamsBot):
         pattern = re.compile(r".*channel register\s+(\w+)\s*")
         try:
             channel_type = pattern.match(activity.text).groups()[0]
-            self._conversation_channels[channel_type] = activity.conversation.id.split(";")[0]
+            channel_id = activity.conversation.id.split(";")[0]
+            self._state_manager.update(("bot_config", "conversation_channels"),
+                                       lambda channels: dict(channels, **{channel_type: channel_id}), dict())
             self.send_reply(f"Nachrichten vom Typ '{channel_type}' werden ab jetzt in diesen Channel gepostet.", activity)
-            self._save_system_config()
         except:
             self.send_reply("Ich habe dich nicht verstanden", activity)
 
@@ -33,10 +47,10 @@ class OpsBot(TeamsBot):
         pattern = re.compile(r".*channel unregister\s+(\w+)\s*")
         try:
             channel_type = pattern.match(activity.text).groups()[0]
-            if channel_type in self._conversation_channels:
-                del self._conversation_channels[channel_type]
+            if channel_type in self._bot_config("conversation_channels", dict()):
+                self._state_manager.update(("bot_config", "conversation_channels"),
+                                           lambda channels: {t: c for t, c in channels.items() if t != channel_type}, dict())
                 self.send_reply(f"Nachrichten vom Typ '{channel_type}' werden ab jetzt in den Default Channel gepostet.", activity)
-                self._save_system_config()
             else:
                 self.send_reply(f"Für Nachrichten Typ '{channel_type}' ist kein Channel registriert.", activity)
         except:
@@ -57,28 +71,88 @@ Ich verstehe die folgenden Kommandos:
 
     def _init_scheduler(self):
         scheduler = BackgroundScheduler()
+        scheduler.add_listener(metrics.job_misfired, EVENT_JOB_MISSED)
         scheduler.start()
         atexit.register(scheduler.shutdown)
         return scheduler
 
+    def _init_leader_election(self):
+        leader_election = self.plugins.leader_election()
+        if leader_election:
+            leader_election.start()
+            atexit.register(leader_election.stop)
+        return leader_election
+
+    def _init_config_watcher(self):
+        interval = get_config_float('config_reload_interval', 5)
+        if interval <= 0:
+            return None
+        watcher = FileWatcher(config_file_path(), self._config_file_changed, interval)
+        watcher.start()
+        atexit.register(watcher.stop)
+        return watcher
+
+    def _init_plugin_watcher(self):
+        interval = get_config_float('config_reload_interval', 5)
+        plugin_dir = get_config_value('additional_plugin_dir')
+        if interval <= 0 or not plugin_dir:
+            return None
+        watcher = DirectoryWatcher(plugin_dir, self.plugins.reload_external_plugins, interval)
+        watcher.start()
+        atexit.register(watcher.stop)
+        return watcher
+
+    def _config_file_changed(self, path):
+        old_config = get_config()
+        try:
+            new_config = reload_config()
+        except Exception as e:
+            logger.error(f"Could not reload config file '{path}'. Keeping the current config: {str(e)}")
+            return
+        logger.info(f"Reloaded config file '{path}'")
+        self.plugins.reload_changed_action_plugins(old_config, new_config)
+
+    def is_leader(self):
+        """ without leader election every instance is the leader """
+        return self._leader_election is None or self._leader_election.is_leader()
+
+    def add_scheduled_job(self, func, trigger, id, run_with=None, **trigger_args):
+        """
+        adds a job to the scheduler which only runs on the leader. If given, run_with(func, id) runs the job,
+        e.g. on the executor of a plugin.
+        """
+        measured = metrics.instrument(func, metrics.JOB_DURATION, metrics.JOBS, job=id)
+
+        @functools.wraps(func)
+        def run_if_leader(*args, **kwargs):
+            if not self.is_leader():
+                logger.debug(f"Not running job '{id}'. This instance is not the leader")
+                return
+            if run_with:
+                return run_with(functools.partial(measured, *args, **kwargs), id)
+            return measured(*args, **kwargs)
+
+        self._scheduler.add_job(run_if_leader, trigger, timezone=TIMEZONE, id=id, replace_existing=True, **trigger_args)
+
+    def remove_scheduled_job(self, id):
+        try:
+            self._scheduler.remove_job(id)
+        except JobLookupError:
+            pass
+
     def init_message(self, activity, mentions):
         self._update_bot_infos(activity)
         self.send_reply("Hallo zusammen. Ich bin der OpsBot.", reply_to=activity)
 
     def save_plugin_variable(self, plugin_type, plugin_name, key, value):
-        def init_key_if_missing(_dict, _key):
-            if _key not in _dict:
-                _dict[_key] = dict()
+        self._state_manager.set(("plugins", plugin_type, plugin_name, key), value)
 
-        if self.read_plugin_variable(plugin_type, plugin_name, key) != value:
-            init_key_if_missing(self._config, 'plugins')
-            init_key_if_missing(self._config['plugins'], plugin_type)
-            init_key_if_missing(self._config['plugins'][plugin_type], plugin_name)
-            self._config['plugins'][plugin_type][plugin_name][key] = value
-            self._save_system_config()
+    def _state_changed_remotely(self, path, value):
+        super()._state_changed_remotely(path, value)
+        if len(path) >= 3 and path[0] == "plugins" and path[1] == "actions":
+            plugin = self.plugins.actions().get(path[2])
+            if plugin:
+                plugin.state_changed()
 
     def read_plugin_variable(self, plugin_type, plugin_name, key):
-        try:
-            return self._config['plugins'][plugin_type][plugin_name][key]
-        except KeyError:
-            return None
+        return self._state_manager.get(("plugins", plugin_type, plugin_name, key))
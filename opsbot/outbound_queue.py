@@ -0,0 +1,132 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+
+from aiohttp import ClientError
+from msrest.exceptions import ClientRequestError
+from requests import RequestException
+
+logger = logging.getLogger()
+
+_STOP = object()
+_RETRY = object()
+
+# Errors of the connection itself. Any other exception without a response is a bug and is not retried
+_TRANSPORT_ERRORS = (OSError, ClientError, ClientRequestError, RequestException)
+
+
+def _retry_after_seconds(response):
+    """Parses the Retry-After header which is either a number of seconds or a HTTP date."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_retryable(error):
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, _TRANSPORT_ERRORS)
+
+
+class OutboundQueue(object):
+    """
+    Sends activities on dedicated worker threads. All activities of one conversation are handled by the same
+    worker, so they are delivered in the order they were submitted. Throttled (429) and failed (5xx or
+    connection errors) sends are retried with exponential backoff, honouring the Retry-After header up to max_delay.
+    A send waiting for its retry holds back the later activities of its conversation, but not those of others.
+    """
+
+    def __init__(self, send_func, concurrency=4, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self._send_func = send_func
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._queues = [queue.Queue() for _ in range(max(1, concurrency))]
+        # Per worker: the activities of each conversation waiting for a retry, the one to retry first
+        self._waiting = [dict() for _ in self._queues]
+        self._workers = [threading.Thread(target=self._work, args=(q, w), name=f"outbound-sender-{i}", daemon=True)
+                         for i, (q, w) in enumerate(zip(self._queues, self._waiting))]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, conversation_id, activity) -> Future:
+        future = Future()
+        worker_queue = self._queues[zlib.crc32(conversation_id.encode()) % len(self._queues)]
+        worker_queue.put((conversation_id, activity, future, 0))
+        return future
+
+    def set_send_func(self, send_func):
+        self._send_func = send_func
+
+    def pending(self):
+        return sum(q.qsize() for q in self._queues) + sum(len(held) for w in self._waiting for held in list(w.values()))
+
+    def shutdown(self, timeout=10.0):
+        """Stops the workers after all queued activities have been sent."""
+        for worker_queue in self._queues:
+            worker_queue.put(_STOP)
+        deadline = time.time() + timeout
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.time()))
+
+    def _work(self, worker_queue, waiting):
+        stopping = False
+        while not (stopping and not waiting):
+            item = worker_queue.get()
+            if item is _STOP:
+                stopping = True
+            elif item[0] is _RETRY:
+                held = waiting.pop(item[1])
+                while held and self._deliver(worker_queue, waiting, held.popleft()):
+                    pass
+                if held:
+                    waiting[item[1]].extend(held)
+            elif item[0] in waiting:
+                waiting[item[0]].append(item)
+            else:
+                self._deliver(worker_queue, waiting, item)
+
+    def _deliver(self, worker_queue, waiting, item):
+        """
+        Sends the activity once. If it has to be retried, it waits in waiting and the worker gets a _RETRY for its
+        conversation after the delay. Returns whether the activity is done.
+        """
+        conversation_id, activity, future, attempt = item
+        if attempt == 0 and not future.set_running_or_notify_cancel():
+            return True
+        try:
+            future.set_result(self._send_func(conversation_id, activity))
+            return True
+        except Exception as e:
+            if not _is_retryable(e) or attempt >= self._max_retries:
+                logger.error(f"Failed to send message to conversation '{conversation_id}': {str(e)}")
+                future.set_exception(e)
+                return True
+            response = getattr(e, "response", None)
+            status = getattr(response, "status_code", None)
+            delay = min(self._max_delay, self._base_delay * 2 ** attempt)
+            retry_after = _retry_after_seconds(response) if status == 429 else None
+            if retry_after is not None:
+                delay = min(retry_after, self._max_delay)
+            logger.warning(f"Sending to conversation '{conversation_id}' failed ({status or str(e)}). "
+                           f"Retry {attempt + 1}/{self._max_retries} in {delay:.1f}s")
+            waiting[conversation_id] = deque([(conversation_id, activity, future, attempt + 1)])
+            timer = threading.Timer(delay, worker_queue.put, args=((_RETRY, conversation_id),))
+            timer.daemon = True
+            timer.start()
+            return False
@@ -4,7 +4,7 @@ from abc import ABC, abstractmethod
 from ntpath import basename, splitext
 from typing import List
 
-from ..config import get_config_value
+from ..config import get_config
 
 
 class OpsbotPlugin(ABC):
@@ -26,8 +26,17 @@ class OpsbotPlugin(ABC):
     def required_configs() -> List[str]:
         return []
 
-    def read_config_value(self, key):
-        return get_config_value(self._config_key(key))
+    def read_config_value(self, key, default=None):
+        return get_config().get(self._config_key(key), default)
+
+    def read_config_int(self, key, default=None):
+        return get_config().get_int(self._config_key(key), default)
+
+    def read_config_float(self, key, default=None):
+        return get_config().get_float(self._config_key(key), default)
+
+    def read_config_bool(self, key, default=False):
+        return get_config().get_bool(self._config_key(key), default)
 
     @classmethod
     @abstractmethod
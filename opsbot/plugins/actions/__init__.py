@@ -1,9 +1,17 @@
+import functools
+import threading
 from abc import abstractmethod
+from concurrent.futures import Future
 from dataclasses import dataclass
 from typing import Optional, List, Callable
 
 from .. import OpsbotPlugin
-from ...utils.time_utils import TIMEZONE
+from ... import metrics
+from ...handler_pool import HandlerPool
+from ...utils.circuit_breaker import CircuitBreaker
+
+UNAVAILABLE_REPLY = "{} ist gerade nicht erreichbar. Bitte versuche es später noch einmal."
+BUSY_REPLY = "Ich bin gerade zu beschäftigt. Bitte versuche es später noch einmal."
 
 
 @dataclass
@@ -11,17 +19,40 @@ class Command:
     command_regexp: Optional[str]  # If None the hook is used for unknown commands. Used in sayings plugin.
     function: Callable
     help_text: Optional[str]
+    timeout: Optional[float] = None  # Seconds after which the command is reported as slow. Defaults to command_timeout
 
 
 class ActionPlugin(OpsbotPlugin):
+    """
+    Commands and scheduled jobs of a plugin run on its own bounded executor, so a plugin waiting for a slow backend
+    only blocks its own workers. Failing or timed out commands and jobs, and failed backend calls made with
+    call_backend, trip the circuit breaker of the plugin. While it is open, commands are answered right away with
+    the unavailable reply and jobs are skipped. Commands and jobs which complete without a failed backend call close
+    it again.
+    """
 
     def __init__(self, opsbot):
         super().__init__(opsbot)
+        self._job_ids = set()
+        self._running_jobs = set()
+        self._running_jobs_lock = threading.Lock()
+        self._pending = list()
+        self._started = False
+        self._command_timeout = self.read_config_float('command_timeout', 60)
+        self._executor = HandlerPool(max_workers=self.read_config_int('workers', 2),
+                                     max_queue=self.read_config_int('queue_size', 20),
+                                     timeout=self._command_timeout, name=f"plugin-{self.plugin_name()}")
+        self._circuit_breaker = CircuitBreaker(self.plugin_name(),
+                                               failure_threshold=self.read_config_int('circuit_breaker.failure_threshold', 5),
+                                               reset_timeout=self.read_config_float('circuit_breaker.reset_timeout', 60))
+        self._backend_failed = threading.local()
+        self._unavailable_reply = self.read_config_value('circuit_breaker.reply', UNAVAILABLE_REPLY.format(self.plugin_name()))
         for hook in self.get_commands():
+            run_with = functools.partial(self._run_command, timeout=hook.timeout)
             if hook.command_regexp:
-                opsbot.register_messagehook_regex(hook.command_regexp, hook.function)
+                self._when_started(opsbot.register_messagehook_regex, hook.command_regexp, self._guarded(hook.function), owner=self, run_with=run_with)
             else:
-                opsbot.register_messagehook_unknown(hook.function)
+                self._when_started(opsbot.register_messagehook_unknown, self._guarded(hook.function), owner=self, run_with=run_with)
 
     @abstractmethod
     def get_commands(self) -> List[Command]:
@@ -31,6 +62,123 @@ class ActionPlugin(OpsbotPlugin):
     def _config_key(cls, key):
         return f"{cls.type()}.{cls.plugin_name()}.{key}"
 
+    def start(self):
+        """
+        Registers the message hooks and schedules the jobs added in __init__. The plugin loader calls it once the plugin
+        is initialized, so a plugin failing in __init__ never replaces the hooks or jobs of the running instance.
+        """
+        self._started = True
+        for func, args, kwargs in self._pending:
+            func(*args, **kwargs)
+        self._pending = list()
+
+    def _when_started(self, func, *args, **kwargs):
+        if self._started:
+            func(*args, **kwargs)
+        else:
+            self._pending.append((func, args, kwargs))
+
+    def shutdown(self, successor=None):
+        """
+        Removes the message hooks and scheduled jobs of this plugin. A successor (the reloaded plugin) takes over
+        the position of the message hooks, its jobs already replaced the jobs with the same id.
+        """
+        successor_job_ids = successor._job_ids if successor else set()
+        for job_id in self._job_ids - successor_job_ids:
+            self._opsbot.remove_scheduled_job(job_id)
+        self._opsbot.unregister_messagehooks(self, successor)
+        self._executor.shutdown(wait=False)
+
+    def _guarded(self, func):
+        """
+        Records the outcome of func for the circuit breaker: an exception as failure and a normal return as success,
+        unless a call_backend failed during func. Those failures are already recorded by call_backend.
+        """
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            self._backend_failed.value = False
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not self._backend_failed.value and not getattr(e, '_recorded_by_circuit_breaker', False):
+                    self._circuit_breaker.record_failure()
+                raise
+            if not self._backend_failed.value:
+                self._circuit_breaker.record_success()
+            return result
+
+        return run
+
+    def _run_command(self, message_func, activity, mentions, timeout=None):
+        """Runs a message hook on the executor of this plugin"""
+        if not self._circuit_breaker.allow():
+            self.send_reply(self._unavailable_reply, reply_to=activity)
+            return
+        if not self._executor.submit(message_func, activity, mentions, timeout=timeout,
+                                     on_timeout=lambda: self._command_timed_out(activity)):
+            self.logger.warning(f"Executor of plugin '{self.plugin_name()}' is full. Rejecting command")
+            self._circuit_breaker.cancel()
+            self.send_reply(BUSY_REPLY, reply_to=activity)
+
+    def _run_job(self, job, job_id):
+        """
+        Runs a scheduled job on the executor of this plugin. The job is skipped while its previous run is still in
+        progress, e.g. after it timed out.
+        """
+        with self._running_jobs_lock:
+            if job_id in self._running_jobs:
+                self.logger.warning(f"Skipping job '{job_id}'. Its previous run is still in progress")
+                return
+            self._running_jobs.add(job_id)
+        if not self._circuit_breaker.allow():
+            self.logger.warning(f"Skipping job '{job_id}'. Plugin '{self.plugin_name()}' is unavailable")
+            self._job_finished(job_id)
+            return
+        if not self._executor.submit(self._tracked_job(job, job_id), on_timeout=self._circuit_breaker.record_failure):
+            self.logger.warning(f"Executor of plugin '{self.plugin_name()}' is full. Skipping job '{job_id}'")
+            self._circuit_breaker.cancel()
+            self._job_finished(job_id)
+
+    def _tracked_job(self, job, job_id):
+        @functools.wraps(job)
+        def run():
+            try:
+                job()
+            finally:
+                self._job_finished(job_id)
+
+        return run
+
+    def _job_finished(self, job_id):
+        with self._running_jobs_lock:
+            self._running_jobs.discard(job_id)
+
+    def _command_timed_out(self, activity):
+        self._circuit_breaker.record_failure()
+        self._opsbot._handler_timed_out(activity)
+
+    def call_backend(self, func, *args, **kwargs):
+        """
+        Calls an external service through the circuit breaker of this plugin. Raises CircuitOpenError without
+        calling func while the breaker is open.
+        """
+        measured = metrics.instrument(func, metrics.BACKEND_DURATION, metrics.BACKEND_REQUESTS, plugin=self.plugin_name())
+        try:
+            return self._circuit_breaker.call(measured, *args, **kwargs)
+        except Exception as e:
+            # Backend calls can run on other threads, e.g. prefetching Jira pages, and their exception is raised
+            # again in the command or job
+            self._backend_failed.value = True
+            e._recorded_by_circuit_breaker = True
+            raise
+
+    def stats(self):
+        return dict(executor=self._executor.stats(), circuit_breaker=self._circuit_breaker.stats())
+
+    def state_changed(self):
+        """Called when another replica changed the variables of this plugin. Plugins caching variables reload them here."""
+        pass
+
     def call_plugin_method(self, plugin_name, method_name, default=None):
         try:
             return getattr(self._opsbot.plugins.actions()[plugin_name], method_name)()
@@ -49,22 +197,27 @@ class ActionPlugin(OpsbotPlugin):
             self.send_message(msg)
 
     def add_scheduled_job(self, func, trigger, id, **trigger_args):
-        self._opsbot._scheduler.add_job(func, trigger, timezone=TIMEZONE, id=f"{self.plugin_name()}_{id}", **trigger_args)
+        self._when_started(self._schedule_job, func, trigger, id, **trigger_args)
+
+    def _schedule_job(self, func, trigger, id, **trigger_args):
+        job_id = f"{self.plugin_name()}_{id}"
+        self._opsbot.add_scheduled_job(self._guarded(func), trigger, id=job_id, run_with=self._run_job, **trigger_args)
+        self._job_ids.add(job_id)
 
-    def send_reply(self, reply, reply_to, mentions=None):
-        self._opsbot.send_reply(reply, reply_to, mentions)
+    def send_reply(self, reply, reply_to, mentions=None) -> Future:
+        return self._opsbot.send_reply(reply, reply_to, mentions)
 
-    def send_message(self, msg, channel_type=None, mentions=None):
-        self._opsbot.send_message(msg, mentions=mentions, channel_type=channel_type)
+    def send_message(self, msg, channel_type=None, mentions=None) -> Future:
+        return self._opsbot.send_message(msg, mentions=mentions, channel_type=channel_type)
 
     def register_messagehook_regex(self, regex, message_func):
-        self._opsbot.register_messagehook_regex(regex, message_func)
+        self._when_started(self._opsbot.register_messagehook_regex, regex, self._guarded(message_func), owner=self, run_with=self._run_command)
 
     def register_messagehook_unknown(self, message_func):
-        self._opsbot.register_messagehook_unknown(message_func)
+        self._when_started(self._opsbot.register_messagehook_unknown, self._guarded(message_func), owner=self, run_with=self._run_command)
 
     def register_messagehook_func(self, matcher_func, message_func):
-        self._opsbot.register_messagehook_func(matcher_func, message_func)
+        self._when_started(self._opsbot.register_messagehook_func, matcher_func, self._guarded(message_func), owner=self, run_with=self._run_command)
 
     def save_variable(self, key, value):
         self._opsbot.save_plugin_variable(self.type(), self.plugin_name(), key, value)
@@ -16,6 +16,7 @@ class AlertsActionPlugin(ActionPlugin):
         self.add_scheduled_job(self.daily_next, 'cron', id='daily_next', day_of_week='mon-fri', hour=8, minute=0)
         self.add_scheduled_job(self.daily_preview, 'cron', id='daily_preview', day_of_week='mon-fri', hour=17, minute=0)
         self._alertmanager_url = self.read_config_value('base_url')
+        self._timeout = self.read_config_float('timeout', 10)
 
     def get_commands(self) -> List[Command]:
         return [Command(r"alerts", self.reply_alerts, "alerts: Gib eine Liste der aktuellen Alerts aus")]
@@ -52,7 +53,7 @@ class AlertsActionPlugin(ActionPlugin):
         end_ts = end.isoformat() + "Z"
         silence = {"id": "", "createdBy": "bot", "comment": "nightly silence", "startsAt": start_ts, "endsAt": end_ts,
                    "matchers": [{"name": "critical", "value": "no", "isRegex": False}]}
-        response = requests.post(self._alertmanager_url + "silences", data=json.dumps(silence))
+        response = self._request("POST", self._alertmanager_url + "silences", data=json.dumps(silence))
         if not response.ok:
             self.logger.info(response)
             self.logger.info(response.text)
@@ -80,10 +81,20 @@ class AlertsActionPlugin(ActionPlugin):
             self.send_error_response("Failed to retrieve alerts", ex, reply_to)
 
     def get_list_of_alerts(self):
-        response = requests.get(self._alertmanager_url + "alerts?silenced=false&inhibited=false")
+        response = self._request("GET", self._alertmanager_url + "alerts?silenced=false&inhibited=false")
         if not response.ok:
             self.logger.info(response)
             self.logger.info(response.text)
             return []
         data = response.json()["data"]
         return [a["labels"]["alertname"] for a in data]
+
+    def _request(self, method, url, **kwargs):
+        """Calls the alertmanager through the circuit breaker. Only unreachable servers and server errors count as failure."""
+        def send():
+            response = requests.request(method, url, timeout=self._timeout, **kwargs)
+            if response.status_code >= 500:
+                response.raise_for_status()
+            return response
+
+        return self.call_backend(send)
@@ -1,17 +1,23 @@
 import re
 import traceback
 from dataclasses import dataclass, field
-from typing import List, Dict
-
-import requests
+from typing import List, Dict, Optional
 
 from . import ActionPlugin, Command
+from ...utils.jira_client import JiraClient
+from ...utils.lru_cache import LRUCache
 from ...utils.time_utils import now, is_today_a_workday
 
 COMMENTS_IN_BRACES = re.compile(r"\(.*\)")
 COLOR_MARKER = re.compile(r"\{color[^}]*\}")
+ORDER_BY = re.compile(r"\s+ORDER\s+BY\s.*$", re.IGNORECASE | re.DOTALL)
 
 DEFECTS_CHANNEL_TYPE = "defects"
+DEFECT_FIELDS = ["status", "priority"]
+TICKET_FIELDS = ["description", "components", "subtasks", "updated"]
+POLL_OVERLAP_SECONDS = 60  # Tolerates clock skew between the bot and Jira
+KEYS_PER_QUERY = 100
+MAX_KNOWN_ISSUE_CHANGES = 50  # Changes of known defects which are persisted separately before they are merged
 
 
 class JiraActionPlugin(ActionPlugin):
@@ -23,9 +29,16 @@ class JiraActionPlugin(ActionPlugin):
         self._jira_base_url = self.read_config_value('base_url')
         self._jira_auth = (self.read_config_value('username'), self.read_config_value('password'))
         self._jira_filter_id = self.read_config_value('defects.filter_id')
+        self._defects_page_size = self.read_config_int('defects.page_size', 100)
+        self._defects_max_results = self.read_config_int('defects.max_results', 1000)
         self._link_defects = self.read_config_value('defects.link_defects')
         self._subtask_project_id = self.read_config_value('subtasks.project_id')
         self._subtask_issue_type = self.read_config_value('subtasks.issue_type')
+        self._subtask_chunk_size = self.read_config_int('subtasks.chunk_size', 50)
+        self._ticket_cache = LRUCache(self.read_config_int('ticket_cache_size', 32))
+        self._jira = JiraClient(self._jira_base_url, self._jira_auth, timeout=self.read_config_float('timeout', 10),
+                                filter_cache_ttl=self.read_config_float('defects.filter_cache_ttl', 3600),
+                                pool_size=self.read_config_int('concurrency', 4), call=self.call_backend)
 
     @staticmethod
     def required_configs() -> List[str]:
@@ -39,6 +52,10 @@ class JiraActionPlugin(ActionPlugin):
             Command(r"defects", self.show_defects, "defects: Gibt aktuelle Defects aus"),
         ]
 
+    def shutdown(self, successor=None):
+        super().shutdown(successor)
+        self._jira.close()
+
     def daily_next(self):
         """Called each morning by scheduler to announce for the day"""
         if not is_today_a_workday():
@@ -59,8 +76,9 @@ class JiraActionPlugin(ActionPlugin):
             return
         try:
             self.send_reply("Einen Moment...", activity)
-            self.create_subtasks(ticket_name)
-            self.send_reply("Subtasks sind angelegt. Viel Spaß beim Implementieren. Möge die Macht mit dir sein.", activity)
+            created, failed, skipped = self.create_subtasks(
+                ticket_name, progress=lambda done, total: self.send_reply(f"{done} von {total} Subtasks angelegt...", activity))
+            self.send_reply(subtask_report(created, failed, skipped), activity)
         except Exception as ex:
             traceback.print_exc()
             self.send_reply("Ein Problem ist aufgetreten: %s." % str(ex), activity)
@@ -94,22 +112,9 @@ class JiraActionPlugin(ActionPlugin):
         if not is_today_a_workday():
             return
         try:
-            issues = self.check_filter()
+            known_issues = self.poll_defects(full_sync=daily)
             self.save_variable("last_check", now().timestamp())
-            if not issues:
-                self.save_variable("issues", issues)
-                return False
-            known_issues = self.read_variable("issues", [])
-            inform_about = list()
-            for issue in issues:
-                known = issue["key"] in known_issues
-                if not known:
-                    inform_about.append(issue)
-            if inform_about:
-                self.inform_about_defects(inform_about)
-            issue_list = [i["key"] for i in issues]
-            self.save_variable("issues", issue_list)
-            return True
+            return bool(known_issues)
         except Exception as ex:
             self.logger.exception("Error while checking JIRA")
             last_check = self.read_variable("last_check", 0)
@@ -118,62 +123,188 @@ class JiraActionPlugin(ActionPlugin):
                 self.save_variable("last_check", now().timestamp())
         return True
 
-    def check_filter(self):
-        response = requests.get(f"{self._jira_base_url}/rest/api/2/filter/%s" % self._jira_filter_id, auth=self._jira_auth)
-        response.raise_for_status()
+    def poll_defects(self, full_sync=False):
+        """
+        Announces new, changed and resolved defects and returns the known defects by key. Without full_sync only
+        the defects updated since the last poll are requested. A full sync reads the whole filter, which also
+        finds defects that were deleted. If the filter has more than defects.max_results defects, known defects
+        which were not read are only resolved if they no longer match the filter. Only the changed defects are
+        persisted, see _save_known_issues.
+        """
+        poll_start = now().timestamp()
+        last_poll = self.read_variable("last_poll")
+        known_issues = self._known_issues()
+        if full_sync or last_poll is None:
+            truncated = list()
+            updated = list(self.check_filter(on_truncated=truncated.append))
+            current = {issue["key"] for issue in updated}
+            resolved = [key for key in known_issues if key not in current]
+            if truncated:
+                resolved = list(self._resolved_defects(resolved))
+        else:
+            since = int((last_poll - POLL_OVERLAP_SECONDS) * 1000)
+            updated = list(self.check_filter(f"updated >= {since}"))
+            resolved = list(self._resolved_defects(known_issues, since))
+
+        new, changed, changes = list(), list(), dict()
+        for issue in updated:
+            known = known_issues.get(issue["key"])
+            values = dict(status=issue["status"], priority=issue["priority"])
+            if known == values:
+                continue
+            if known is None:
+                new.append(issue)
+            elif known["status"] is not None:  # Defects migrated from the key list have no values yet
+                changed.append(issue)
+            known_issues[issue["key"]] = changes[issue["key"]] = values
+        resolved = [key for key in resolved if known_issues.pop(key, None) is not None]
+        changes.update((key, None) for key in resolved)
+
+        if new:
+            self.inform_about_defects(new)
+        if changed:
+            self.inform_about_changed_defects(changed)
+        if resolved:
+            self.inform_about_resolved_defects(resolved)
+        if changes or self.read_variable("known_issues") is None:
+            self._save_known_issues(known_issues, changes)
+        if self.read_variable("issues") is not None:
+            self.save_variable("issues", None)
+        self.save_variable("last_poll", poll_start)
+        return known_issues
 
-        url = response.json()["searchUrl"]
-        response = requests.get(url, auth=self._jira_auth)
-        if response.ok:
-            issues = response.json()["issues"]
-            return [dict(key=i["key"], status=i.get("fields", dict()).get("status", dict()).get("name", "UNKNOWN"),
-                         priority=i.get("fields", dict()).get("priority", dict()).get("name", "UNKNOWN")) for i in issues]
+    def _known_issues(self):
+        known_issues = self.read_variable("known_issues")
+        if known_issues is None:
+            # Migrate the key list of older versions
+            known_issues = {key: dict(status=None, priority=None) for key in self.read_variable("issues", [])}
+        known_issues = dict(known_issues)
+        for key, values in self.read_variable("known_issue_changes", dict()).items():
+            if values is None:
+                known_issues.pop(key, None)
+            else:
+                known_issues[key] = values
+        return known_issues
+
+    def _save_known_issues(self, known_issues, changes):
+        """
+        Persists the changed and resolved (None) defects as known_issue_changes, so a single change does not rewrite
+        all known defects. Once there are more than MAX_KNOWN_ISSUE_CHANGES, they are merged into known_issues.
+        """
+        pending = dict(self.read_variable("known_issue_changes", dict()))
+        pending.update(changes)
+        if len(pending) > MAX_KNOWN_ISSUE_CHANGES or self.read_variable("known_issues") is None:
+            self.save_variable("known_issues", known_issues)
+            self.save_variable("known_issue_changes", None)
+        else:
+            self.save_variable("known_issue_changes", pending)
+
+    def _resolved_defects(self, known_issues, since=None):
+        """Yields the known defects that no longer match the filter. With since only those updated since then."""
+        jql = self._filter_jql()
+        keys = sorted(known_issues)
+        updated = f" AND updated >= {since}" if since is not None else ""
+        for i in range(0, len(keys), KEYS_PER_QUERY):
+            query = f"key in ({','.join(keys[i:i + KEYS_PER_QUERY])}){updated} AND NOT ({jql})"
+            # Keys of deleted defects are only a warning, not an invalid query
+            for issue in self._jira.search(query, fields=DEFECT_FIELDS, page_size=self._defects_page_size,
+                                           validate_query="warn"):
+                yield issue["key"]
+
+    def _filter_jql(self):
+        """The JQL of the defects filter without ORDER BY, so it can be combined with further conditions"""
+        return ORDER_BY.sub("", self._jira.filter_jql(self._jira_filter_id))
+
+    def check_filter(self, condition=None, on_truncated=None):
+        jql = f"({self._filter_jql()}) AND {condition}" if condition else self._jira.filter_jql(self._jira_filter_id)
+        for i in self._jira.search(jql, fields=DEFECT_FIELDS, page_size=self._defects_page_size,
+                                   max_results=self._defects_max_results, on_truncated=on_truncated):
+            yield dict(key=i["key"], status=i.get("fields", dict()).get("status", dict()).get("name", "UNKNOWN"),
+                       priority=i.get("fields", dict()).get("priority", dict()).get("name", "UNKNOWN"))
 
     def inform_about_defects(self, issues):
         for issue in issues:
             self.send_message(
-                f'Neuer Defect {issue["key"]} <a href="{self._jira_base_url}/browse/{issue["key"]}">{self._jira_base_url}/browse/{issue["key"]}</a> mit Priority "{issue["priority"]}" im Status "{issue["status"]}".\r\n',
+                f'Neuer Defect {self._defect_link(issue["key"])} mit Priority "{issue["priority"]}" im Status "{issue["status"]}".\r\n',
                 channel_type=DEFECTS_CHANNEL_TYPE)
 
+    def inform_about_changed_defects(self, issues):
+        for issue in issues:
+            self.send_message(
+                f'Defect {self._defect_link(issue["key"])} hat jetzt Priority "{issue["priority"]}" und Status "{issue["status"]}".\r\n',
+                channel_type=DEFECTS_CHANNEL_TYPE)
+
+    def inform_about_resolved_defects(self, keys):
+        for key in keys:
+            self.send_message(f'Defect {self._defect_link(key)} ist erledigt.\r\n', channel_type=DEFECTS_CHANNEL_TYPE)
+
+    def _defect_link(self, key):
+        return f'{key} <a href="{self._jira_base_url}/browse/{key}">{self._jira_base_url}/browse/{key}</a>'
+
     def report_error(self, reason):
         person_today = self.call_plugin_method("operations", "current", default='general')
         self.send_message(
-            f'<at>{person_today}</at> Ich konnte JIRA nicht prüfen. ({reason}). Bitte prüfe selbst ob es neue Defects gibt: <a href="{self._link_defects}">{self._link_defects}</a>',
+            f'<at>{person_today}</at> Ich konnte JIRA nicht prüfen. ({reason}). '
+            f'Bitte prüfe selbst ob es neue Defects gibt: <a href="{self._link_defects}">{self._link_defects}</a>',
             channel_type=DEFECTS_CHANNEL_TYPE, mentions=[person_today])
 
-    def create_subtasks(self, ticket):
+    def create_subtasks(self, ticket, progress=None):
+        """
+        Creates a subtask for every task of the ticket that is not a subtask yet, so running it again only creates
+        the missing ones. Calls progress(done, total) after every chunk but the last.
+        Returns the created (task, key) and failed (task, error) tasks and the skipped tasks.
+        """
         ticket = self.retrieve_tasks_from_ticket(ticket)
-        for task in ticket.subtasks:
-            self.create_subtask(ticket, task)
-
-    def create_subtask(self, ticket, text):
-        data = dict(
-            fields=dict(
-                project=dict(id=self._subtask_project_id),
-                summary=text,
-                issuetype=dict(id=self._subtask_issue_type),
-                parent=dict(key=ticket.key.upper()),
-                components=ticket.components,
-            )
+        existing = set(ticket.existing_subtasks)
+        skipped = [task for task in ticket.subtasks if task in existing]
+        tasks = [task for task in ticket.subtasks if task not in existing]
+        self.logger.info(f"Creating {len(tasks)} subtasks for {ticket.key}. {len(skipped)} already exist")
+        created, failed = list(), list()
+        pending = iter(tasks)
+        try:
+            for results in self._jira.create_issues([self._subtask_fields(ticket, task) for task in tasks],
+                                                    chunk_size=self._subtask_chunk_size):
+                for key, error in results:
+                    task = next(pending)
+                    if key:
+                        created.append((task, key))
+                    else:
+                        failed.append((task, error))
+                if progress and len(created) + len(failed) < len(tasks):
+                    progress(len(created) + len(failed), len(tasks))
+        except Exception as ex:
+            self.logger.exception(f"Error while creating subtasks for {ticket.key}")
+            failed.extend((task, str(ex)) for task in pending)
+        if created:
+            # The cached ticket does not know the new subtasks
+            self._ticket_cache.remove(ticket.key.upper())
+        return created, failed, skipped
+
+    def _subtask_fields(self, ticket, text):
+        return dict(
+            project=dict(id=self._subtask_project_id),
+            summary=text,
+            issuetype=dict(id=self._subtask_issue_type),
+            parent=dict(key=ticket.key.upper()),
+            components=ticket.components,
         )
-        print("Creating ticket for {} with summary '{}'".format(ticket.key, text))
-        response = requests.post(f"{self._jira_base_url}/rest/api/2/issue/", json=data, auth=self._jira_auth)
-        print(response.text, flush=True)
-        if not response.ok:
-            raise Exception("Failed to create subtask: {} {}".format(response.status_code, response.text))
 
     def retrieve_tasks_from_ticket(self, ticket):
+        """
+        Returns the ticket with the tasks from its description. Fetched and parsed tickets are cached. A cached
+        ticket is used as long as its 'updated' field is unchanged, which is checked with a request for just that field.
+        """
+        cached = self._ticket_cache.get(ticket.upper())
+        if cached and cached.updated == self._jira.get_issue(ticket, fields=["updated"])["fields"].get("updated"):
+            return cached
         ticket = self.retrieve_ticket(ticket)
         tasks = list(extract_subtasks(ticket.text))
         ticket.subtasks = tasks
+        self._ticket_cache.put(ticket.key.upper(), ticket)
         return ticket
 
     def retrieve_ticket(self, ticket):
-        response = requests.get(f"{self._jira_base_url}/rest/api/2/issue/" + ticket, auth=self._jira_auth)
-        if not response.ok:
-            print(response.text, flush=True)
-            raise Exception("Failed to get ticket")
-        data = response.json()
+        data = self._jira.get_issue(ticket, fields=TICKET_FIELDS)
         if not "fields" in data:
             raise Exception("JIRA API response does not contain fields.")
         if not "description" in data["fields"]:
@@ -182,7 +313,25 @@ class JiraActionPlugin(ActionPlugin):
         # assignee = data["fields"].get("assignee", dict()).get("key")
         jira_components = data["fields"].get("components", list())
         components = [dict(id=c["id"], name=c["name"]) for c in jira_components]
-        return JiraTicket(ticket, text, "", components)
+        existing_subtasks = [s.get("fields", dict()).get("summary") for s in data["fields"].get("subtasks", list())]
+        return JiraTicket(ticket, text, "", components, existing_subtasks=existing_subtasks,
+                          updated=data["fields"].get("updated"))
+
+
+def subtask_report(created, failed, skipped):
+    if not created and not failed:
+        return "Alle Subtasks sind bereits angelegt."
+    lines = list()
+    if created:
+        lines.append("Angelegt: " + ", ".join(f"{key} {task}" for task, key in created))
+    if skipped:
+        lines.append("Bereits vorhanden: " + ", ".join(skipped))
+    if failed:
+        lines.append("Fehlgeschlagen: " + ", ".join(f"{task} ({error})" for task, error in failed))
+        lines.append("Ein erneutes 'gen subtasks' legt nur die fehlenden Subtasks an.")
+    else:
+        lines.append("Subtasks sind angelegt. Viel Spaß beim Implementieren. Möge die Macht mit dir sein.")
+    return "\n".join(lines)
 
 
 def extract_subtasks(text):
@@ -246,3 +395,5 @@ class JiraTicket:
     assignee: str
     components: List[Dict]
     subtasks: List[str] = field(default_factory=list)
+    existing_subtasks: List[str] = field(default_factory=list)
+    updated: Optional[str] = None
@@ -3,7 +3,7 @@ from datetime import datetime
 from typing import List
 
 from . import Command
-from ...config import get_config_value
+from ...config import get_config_list
 from ...plugins.actions import ActionPlugin
 from ...utils.cyclic_list import CyclicList
 from ...utils.time_utils import is_it_late, is_today_a_workday, next_workday, now, next_workday_string, DATE_FORMAT
@@ -12,7 +12,7 @@ OPERATIONS_CHANNEL_TYPE = "operations"
 
 
 def format_gender(name):
-    return "die" if name in get_config_value('woman', []) else "der"
+    return "die" if name in get_config_list('woman') else "der"
 
 
 class OperationsActionPlugin(ActionPlugin):
@@ -20,11 +20,8 @@ class OperationsActionPlugin(ActionPlugin):
     def __init__(self, opsbot):
         super().__init__(opsbot)
         self._members = CyclicList([], dynamic=True)
-        self._members.load_state(self.read_variable("members", dict()))
-        self._vacations = self.read_variable("vacations", list())
-        self._user_override = self.read_variable("override", None)
         self._sayings_responsible_today = CyclicList(self.read_config_value('quotes'))
-        self._sayings_responsible_today.load_state(self.read_variable("sayings_responsible_today", dict()))
+        self.state_changed()
         self._override_user = self.read_config_value('override_user')
         self._how_to_link = self.read_config_value('how_to_link')
         self.add_scheduled_job(self.daily_next, 'cron', id='daily_next', day_of_week='mon-fri', hour=8, minute=0)
@@ -33,6 +30,12 @@ class OperationsActionPlugin(ActionPlugin):
         self._operator_text_tomorrow = self.read_config_value('operator_text_tomorrow')
 
 
+    def state_changed(self):
+        self._members.load_state(self.read_variable("members", dict()))
+        self._vacations = self.read_variable("vacations", list())
+        self._user_override = self.read_variable("override", None)
+        self._sayings_responsible_today.load_state(self.read_variable("sayings_responsible_today", dict()))
+
     def get_commands(self) -> List[Command]:
         return [
             Command(r"((register)|(add))", self.register, "register @user: Person in die Rotation mit aufnehmen"),
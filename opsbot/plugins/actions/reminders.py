@@ -69,7 +69,10 @@ class RemindersActionPlugin(ActionPlugin):
 
         # For debugging:
         # self.add_scheduled_job(self._remind_events, 'cron', id='debug', day_of_week='*', hour='*', minute='*')
-        
+
+        self.state_changed()
+
+    def state_changed(self):
         self._latest_reminder_run = _parse_date(
             self.read_variable("latest_reminder_run", default=str(today_date())),
             "%Y-%m-%d"
@@ -12,6 +12,9 @@ class SayingsActionPlugin(ActionPlugin):
     def __init__(self, opsbot):
         super().__init__(opsbot)
         self._sayings_unknown_command = CyclicList(self.read_config_value('insults'))
+        self.state_changed()
+
+    def state_changed(self):
         self._sayings_unknown_command.load_state(self.read_variable("sayings_state"))
 
     @staticmethod
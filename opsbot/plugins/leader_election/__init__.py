@@ -0,0 +1,74 @@
+import os
+import socket
+import threading
+import time
+from abc import abstractmethod
+
+from .. import OpsbotPlugin
+
+
+class LeaderElectionPlugin(OpsbotPlugin):
+    """
+    Elects one leader among all replicas of the bot. Only the leader runs scheduled jobs, all replicas handle
+    incoming messages. The election runs in a background thread which tries to acquire or renew the leadership
+    every retry_period seconds. A leader which can not renew steps down immediately. A leader whose last successful
+    renewal is more than renew_deadline seconds ago no longer acts as leader, even if the renewal is still running.
+    """
+
+    def __init__(self, opsbot):
+        super().__init__(opsbot)
+        self._identity = f"{socket.gethostname()}_{os.getpid()}"
+        self._lease_duration = self.read_config_float('lease_duration', 15)
+        self._retry_period = self.read_config_float('retry_period', 2)
+        self._renew_deadline = self.read_config_float('renew_deadline', self._lease_duration * 2 / 3)
+        self._is_leader = False
+        self._renewed_at = 0.0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="leader-election", daemon=True)
+
+    @abstractmethod
+    def try_acquire_or_renew(self) -> bool:
+        """Acquires the leadership or renews it if already held. Returns whether this replica is the leader."""
+        pass
+
+    @abstractmethod
+    def release(self):
+        pass
+
+    @classmethod
+    def _config_key(cls, key):
+        return f"{cls.type()}.{key}"
+
+    def identity(self):
+        return self._identity
+
+    def is_leader(self) -> bool:
+        return self._is_leader and time.monotonic() - self._renewed_at < self._renew_deadline
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._is_leader:
+            self._is_leader = False
+            try:
+                self.release()
+            except Exception as e:
+                self.logger.warning(f"Could not release leadership: {str(e)}")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # The lease is renewed as of the start of the attempt, the request may take a while
+            attempt_start = time.monotonic()
+            try:
+                leader = self.try_acquire_or_renew()
+            except Exception as e:
+                self.logger.warning(f"Leader election failed: {str(e)}")
+                leader = False
+            if leader != self._is_leader:
+                self.logger.info(f"'{self._identity}' {'is now' if leader else 'is no longer'} the leader")
+            if leader:
+                self._renewed_at = attempt_start
+            self._is_leader = leader
+            self._stopped.wait(self._retry_period)
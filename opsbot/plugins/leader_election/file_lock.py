@@ -0,0 +1,41 @@
+import fcntl
+import os
+from typing import List
+
+from . import LeaderElectionPlugin
+
+
+class FileLockLeaderElectionPlugin(LeaderElectionPlugin):
+    """
+    Leader election with an exclusive lock on a local file. Only works for replicas on the same host,
+    e.g. for local tests. The lock is released by the operating system if the leader process dies.
+    """
+
+    def __init__(self, opsbot):
+        super().__init__(opsbot)
+        self._path = self.read_config_value('path')
+        self._fd = None
+
+    @staticmethod
+    def required_configs() -> List[str]:
+        return ['path']
+
+    def try_acquire_or_renew(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, self._identity.encode('utf-8'))
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
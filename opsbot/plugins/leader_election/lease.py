@@ -0,0 +1,97 @@
+import os
+from datetime import datetime, timezone
+from typing import List
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from kubernetes.config import load_incluster_config, load_kube_config
+
+from . import LeaderElectionPlugin
+
+
+def _load_kubernetes_config():
+    if os.environ.get("KUBERNETES_SERVICE_HOST") is not None:
+        load_incluster_config()
+    else:
+        load_kube_config()
+
+
+def _now():
+    return datetime.now(tz=timezone.utc)
+
+
+class LeaseLeaderElectionPlugin(LeaderElectionPlugin):
+    """
+    Leader election with a Kubernetes coordination.k8s.io/v1 Lease. The leader renews the lease every retry period.
+    Other replicas take over once the lease was not renewed for lease_duration seconds. Updates use the
+    resourceVersion of the read lease, so only one replica can win a takeover.
+    """
+
+    def __init__(self, opsbot):
+        super().__init__(opsbot)
+        _load_kubernetes_config()
+        self._kubernetes_client = client.CoordinationV1Api()
+        self._lease_name = self.read_config_value('lease_name')
+        self._lease_namespace = self.read_config_value('lease_namespace')
+        # A hanging request must not outlast the renew deadline
+        self._request_timeout = self.read_config_float('request_timeout', min(self._retry_period, self._renew_deadline))
+
+    @staticmethod
+    def required_configs() -> List[str]:
+        return ['lease_name', 'lease_namespace']
+
+    def try_acquire_or_renew(self) -> bool:
+        now = _now()
+        try:
+            lease = self._kubernetes_client.read_namespaced_lease(self._lease_name, self._lease_namespace, _request_timeout=self._request_timeout)
+        except ApiException as e:
+            if e.status != 404:
+                raise
+            return self._create_lease(now)
+
+        spec = lease.spec
+        holder = spec.holder_identity
+        if holder and holder != self._identity and not self._expired(spec, now):
+            return False
+        if holder != self._identity:
+            spec.holder_identity = self._identity
+            spec.acquire_time = now
+            spec.lease_transitions = (spec.lease_transitions or 0) + 1
+        spec.lease_duration_seconds = int(self._lease_duration)
+        spec.renew_time = now
+        try:
+            self._kubernetes_client.replace_namespaced_lease(self._lease_name, self._lease_namespace, lease, _request_timeout=self._request_timeout)
+        except ApiException as e:
+            if e.status == 409:
+                # Another replica updated the lease in the meantime
+                return False
+            raise
+        return True
+
+    def _expired(self, spec, now):
+        renew_time = spec.renew_time or spec.acquire_time
+        if not renew_time:
+            return True
+        duration = spec.lease_duration_seconds or self._lease_duration
+        return (now - renew_time).total_seconds() > duration
+
+    def _create_lease(self, now):
+        lease = client.V1Lease(
+            metadata=client.V1ObjectMeta(name=self._lease_name, namespace=self._lease_namespace),
+            spec=client.V1LeaseSpec(holder_identity=self._identity, lease_duration_seconds=int(self._lease_duration),
+                                    acquire_time=now, renew_time=now, lease_transitions=0))
+        try:
+            self._kubernetes_client.create_namespaced_lease(self._lease_namespace, lease, _request_timeout=self._request_timeout)
+        except ApiException as e:
+            if e.status == 409:
+                return False
+            raise
+        return True
+
+    def release(self):
+        lease = self._kubernetes_client.read_namespaced_lease(self._lease_name, self._lease_namespace, _request_timeout=self._request_timeout)
+        if lease.spec.holder_identity != self._identity:
+            return
+        lease.spec.holder_identity = None
+        lease.spec.renew_time = None
+        self._kubernetes_client.replace_namespaced_lease(self._lease_name, self._lease_namespace, lease, _request_timeout=self._request_timeout)
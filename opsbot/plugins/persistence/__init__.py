@@ -2,6 +2,7 @@ from abc import abstractmethod
 from typing import Dict
 
 from .. import OpsbotPlugin
+from ... import metrics
 
 
 class PersistencePlugin(OpsbotPlugin):
@@ -14,6 +15,23 @@ class PersistencePlugin(OpsbotPlugin):
     def persist_state(self, state):
         pass
 
+    def persist_keys(self, state, keys):
+        """
+        Persists the changed entries of the state, given as key paths like ('bot_config', 'user_map') or
+        ('plugins', 'actions', 'jira', 'issues'). Plugins that store the state as a whole write the complete state.
+        """
+        self.persist_state(state)
+
+    def watch(self, callback):
+        """
+        Calls callback(path, value) for every entry of the state another replica changed, with paths like
+        ('bot_config',) or ('plugins', 'actions', 'jira'). Plugins without shared storage never call it.
+        """
+        pass
+
+    def _count_written_bytes(self, size):
+        metrics.PERSISTENCE_BYTES.labels(plugin=self.plugin_name()).inc(size)
+
     @classmethod
     def _config_key(cls, key):
         return f"{cls.type()}.{key}"
@@ -1,19 +1,74 @@
+import base64
+import gzip
 import logging
 import os
+import threading
 from typing import List
 
 import oyaml
-from kubernetes import client
+from kubernetes import client, watch
 from kubernetes.client.rest import ApiException
 from kubernetes.config import load_incluster_config, load_kube_config
 from requests.packages.urllib3 import disable_warnings
 
 from . import PersistencePlugin
+from ...utils.state_paths import MISSING, get_path, replace_path
 
 disable_warnings()
 
 logging.getLogger("kubernetes.client.rest").setLevel(logging.INFO)
 
+LEGACY_KEY = 'yaml_data'
+SHARD_SUFFIX = '.yaml'
+COMPRESSED_SHARD_SUFFIX = '.yaml.gz'
+CONFIGMAP_SIZE_LIMIT = 1024 * 1024
+MAX_CONFLICT_RETRIES = 5
+WATCH_TIMEOUT_SECONDS = 300
+WATCH_RETRY_SECONDS = 5
+
+
+def _shard_name(path):
+    """Plugin variables are sharded per plugin, everything else per top level key."""
+    if path[0] == 'plugins' and len(path) >= 3:
+        return '.'.join(path[:3])
+    return path[0]
+
+
+def _shard_names(state):
+    for key, value in state.items():
+        if key == 'plugins':
+            for plugin_type, plugins in value.items():
+                for plugin_name in plugins:
+                    yield f"plugins.{plugin_type}.{plugin_name}"
+        else:
+            yield key
+
+
+def _get_shard(state, shard_name):
+    ptr = state
+    for key in shard_name.split('.'):
+        ptr = ptr.get(key, dict())
+    return ptr
+
+
+def _set_shard(state, shard_name, value):
+    keys = shard_name.split('.')
+    ptr = state
+    for key in keys[:-1]:
+        ptr = ptr.setdefault(key, dict())
+    ptr[keys[-1]] = value
+
+
+def _shard_path(shard_name):
+    return tuple(shard_name.split('.'))
+
+
+def _resource_version_number(resource_version):
+    try:
+        return int(resource_version)
+    except (TypeError, ValueError):
+        return 0
+
 
 def _load_kubernetes_config():
     if os.environ.get("KUBERNETES_SERVICE_HOST") is not None:
@@ -26,15 +81,28 @@ class ConfigmapPersistencePlugin(PersistencePlugin):
 
     def __init__(self, opsbot):
         super().__init__(opsbot)
-        _load_kubernetes_config()
-        self._kubernetes_client = client.CoreV1Api()
+        self._kubernetes_client = self._create_kubernetes_client()
         self._configmap_name = self.read_config_value('configmap_name')
         self._configmap_namespace = self.read_config_value('configmap_namespace')
+        self._compress = self.read_config_bool('compress')
+        self._written = dict()
+        self._legacy_key_present = False
+        self._resource_version = None
+        self._lock = threading.RLock()
+        self._watch_callback = None
+        self._watch_thread = threading.Thread(target=self._watch, name="configmap-watch", daemon=True)
 
     @staticmethod
     def required_configs() -> List[str]:
         return ['configmap_name', 'configmap_namespace']
 
+    def _create_kubernetes_client(self):
+        _load_kubernetes_config()
+        return client.CoreV1Api()
+
+    def _create_watch(self):
+        return watch.Watch()
+
     def _create_configmap(self):
         configmap = client.V1ConfigMap(
             api_version="v1",
@@ -42,25 +110,198 @@ class ConfigmapPersistencePlugin(PersistencePlugin):
             metadata=dict(name=self._configmap_name),
             data=dict()
         )
-        self._kubernetes_client.create_namespaced_config_map(self._configmap_namespace, configmap)
+        return self._kubernetes_client.create_namespaced_config_map(self._configmap_namespace, configmap)
 
     def read_state(self):
+        configmap = self._read_configmap()
+        if configmap is None:
+            configmap = self._create_configmap()
+        with self._lock:
+            self._resource_version = configmap.metadata.resource_version
+            return self._state_from_configmap(configmap)
+
+    def _read_configmap(self):
         try:
-            data = self._kubernetes_client.read_namespaced_config_map(self._configmap_name, self._configmap_namespace, pretty=False, exact=False).data
-            if data and 'yaml_data' in data:
-                return oyaml.safe_load(data['yaml_data'])
-            else:
-                return {}
+            return self._kubernetes_client.read_namespaced_config_map(self._configmap_name, self._configmap_namespace, pretty=False, exact=False)
         except ApiException as e:
             if e.status == 404:
-                self._create_configmap()
-                return {}
+                return None
             else:
                 self.logger.critical(f"Error while reading state from configmap '{self._configmap_name}' in namespace '{self._configmap_namespace}'")
                 raise e
 
+    def _state_from_configmap(self, configmap):
+        data = configmap.data or dict()
+        binary_data = configmap.binary_data or dict()
+        state = dict()
+        self._legacy_key_present = LEGACY_KEY in data
+        if self._legacy_key_present:
+            state = oyaml.safe_load(data[LEGACY_KEY]) or dict()
+        for shard_name, (serialized, compressed) in self._shards_from_configmap(configmap).items():
+            self._written[shard_name] = (serialized, compressed)
+            _set_shard(state, shard_name, oyaml.safe_load(serialized))
+        return state
+
+    @staticmethod
+    def _shards_from_configmap(configmap):
+        shards = dict()
+        for key, value in (configmap.data or dict()).items():
+            if key.endswith(SHARD_SUFFIX):
+                shards[key[:-len(SHARD_SUFFIX)]] = (value, False)
+        for key, value in (configmap.binary_data or dict()).items():
+            if key.endswith(COMPRESSED_SHARD_SUFFIX):
+                serialized = gzip.decompress(base64.b64decode(value)).decode('utf-8')
+                shards[key[:-len(COMPRESSED_SHARD_SUFFIX)]] = (serialized, True)
+        return shards
+
+    def _take_over_remote_shards(self, configmap):
+        """
+        Remembers the shards of a configmap written by another replica. Returns the changed shards as
+        (path, value) pairs. Events older than the last known version are ignored.
+        """
+        with self._lock:
+            resource_version = configmap.metadata.resource_version
+            if _resource_version_number(resource_version) < _resource_version_number(self._resource_version):
+                return []
+            self._resource_version = resource_version
+            changes = []
+            for shard_name, (serialized, compressed) in self._shards_from_configmap(configmap).items():
+                written = self._written.get(shard_name)
+                if written is not None and written[0] == serialized:
+                    continue
+                self._written[shard_name] = (serialized, compressed)
+                changes.append((_shard_path(shard_name), oyaml.safe_load(serialized)))
+            return changes
+
+    def _notify(self, changes):
+        if not self._watch_callback:
+            return
+        for path, value in changes:
+            self.logger.info(f"State '{'.'.join(path)}' was changed by another replica")
+            try:
+                self._watch_callback(path, value)
+            except Exception:
+                self.logger.exception(f"Error while applying remote change of '{'.'.join(path)}'")
+
     def persist_state(self, state):
-        try:
-            self._kubernetes_client.patch_namespaced_config_map(self._configmap_name, self._configmap_namespace, {'data': {"yaml_data": oyaml.safe_dump(state)}})
-        except ApiException as e:
-            self.logger.error(f"Error while writing state to configmap '{self._configmap_name}' in namespace '{self._configmap_namespace}': {str(e)}")
+        self._persist_shards(state, set(_shard_names(state)))
+
+    def persist_keys(self, state, keys):
+        self._persist_shards(state, {_shard_name(path) for path in keys}, keys)
+
+    def _persist_shards(self, state, shard_names, keys=None):
+        """
+        Patches the changed shards with the last known resourceVersion. If another replica wrote in the meantime
+        the patch is rejected with a conflict. The other replica's shards are then merged into the state, keeping
+        the local changes which are being written, and the patch is built again from the merged state. Raises if the
+        shards could not be written, so they stay dirty and are written again later.
+        """
+        for attempt in range(MAX_CONFLICT_RETRIES + 1):
+            with self._lock:
+                patch, changed = self._build_patch(state, shard_names)
+                if not changed:
+                    return
+                patch['metadata'] = {'resourceVersion': self._resource_version}
+            try:
+                configmap = self._kubernetes_client.patch_namespaced_config_map(self._configmap_name, self._configmap_namespace, patch)
+            except ApiException as e:
+                if e.status == 409 and attempt < MAX_CONFLICT_RETRIES:
+                    self.logger.info(f"Configmap '{self._configmap_name}' was changed by another replica. Merging and retrying")
+                    state = self._merge_remote_changes(state, keys)
+                    continue
+                self.logger.error(f"Error while writing state to configmap '{self._configmap_name}' in namespace '{self._configmap_namespace}': {str(e)}")
+                raise
+            self._count_written_bytes(sum(len(value) for values in (patch['data'], patch['binaryData'])
+                                          for value in values.values() if value))
+            with self._lock:
+                self._written.update(changed)
+                self._legacy_key_present = False
+                if _resource_version_number(configmap.metadata.resource_version) > _resource_version_number(self._resource_version):
+                    self._resource_version = configmap.metadata.resource_version
+            self._warn_if_too_large()
+            return
+
+    def _build_patch(self, state, shard_names):
+        if self._legacy_key_present:
+            # Migrate from the single key format by writing all shards once
+            shard_names = set(_shard_names(state))
+            self._written.clear()
+        data = dict()
+        binary_data = dict()
+        changed = dict()
+        for shard_name in shard_names:
+            serialized = oyaml.safe_dump(_get_shard(state, shard_name))
+            if self._written.get(shard_name) == (serialized, self._compress):
+                continue
+            changed[shard_name] = (serialized, self._compress)
+            if self._compress:
+                binary_data[shard_name + COMPRESSED_SHARD_SUFFIX] = base64.b64encode(gzip.compress(serialized.encode('utf-8'))).decode('ascii')
+                data[shard_name + SHARD_SUFFIX] = None
+            else:
+                data[shard_name + SHARD_SUFFIX] = serialized
+                binary_data[shard_name + COMPRESSED_SHARD_SUFFIX] = None
+        if changed and self._legacy_key_present:
+            data[LEGACY_KEY] = None
+        return {'data': data, 'binaryData': binary_data}, changed
+
+    def _merge_remote_changes(self, state, keys):
+        """
+        Takes over the shards another replica wrote. Returns the state with the remote shards and the changed keys
+        of this replica on top. Without keys the whole local state is written again.
+        """
+        configmap = self._read_configmap()
+        if configmap is None:
+            return state
+        changes = self._take_over_remote_shards(configmap)
+        # The watch callback merges the remote shards into the bot state the same way
+        self._notify(changes)
+        if keys is None:
+            return state
+        merged = state
+        for path, value in changes:
+            if any(path[:len(key)] == key for key in keys):
+                continue
+            merged = replace_path(merged, path, value)
+            for key in keys:
+                local_value = get_path(state, key)
+                if key[:len(path)] == path and local_value is not MISSING:
+                    merged = replace_path(merged, key, local_value)
+        return merged
+
+    def watch(self, callback):
+        self._watch_callback = callback
+        self._watch_thread.start()
+
+    def _watch(self):
+        resource_version = self._resource_version
+        while True:
+            try:
+                if resource_version is None:
+                    configmap = self._read_configmap()
+                    if configmap is not None:
+                        self._notify(self._take_over_remote_shards(configmap))
+                    resource_version = self._resource_version
+                stream = self._create_watch().stream(self._kubernetes_client.list_namespaced_config_map, self._configmap_namespace,
+                                              field_selector=f"metadata.name={self._configmap_name}",
+                                              resource_version=resource_version, timeout_seconds=WATCH_TIMEOUT_SECONDS)
+                for event in stream:
+                    configmap = event['object']
+                    resource_version = configmap.metadata.resource_version
+                    if event['type'] in ('ADDED', 'MODIFIED'):
+                        self._notify(self._take_over_remote_shards(configmap))
+            except ApiException as e:
+                if e.status != 410:
+                    self.logger.warning(f"Watching configmap '{self._configmap_name}' failed: {str(e)}")
+                    threading.Event().wait(WATCH_RETRY_SECONDS)
+                # The resource version is too old, read the configmap again
+                resource_version = None
+            except Exception as e:
+                self.logger.warning(f"Watching configmap '{self._configmap_name}' failed: {str(e)}")
+                threading.Event().wait(WATCH_RETRY_SECONDS)
+                resource_version = None
+
+    def _warn_if_too_large(self):
+        size = sum(len(serialized) for serialized, _ in self._written.values())
+        if not self._compress and size > CONFIGMAP_SIZE_LIMIT * 0.8:
+            self.logger.warning(f"State in configmap '{self._configmap_name}' has {size} bytes and is close to the limit of {CONFIGMAP_SIZE_LIMIT} bytes. "
+                                f"Consider setting 'persistence.compress'.")
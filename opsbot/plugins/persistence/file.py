@@ -1,9 +1,59 @@
+import json
 import os
+import threading
 from typing import Dict
 
 import oyaml
 
 from . import PersistencePlugin
+from ...utils.atomic_file import write_atomic
+from ...utils.journal import Journal
+from ...utils.state_paths import MISSING, get_path, set_path
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _dump_yaml(state) -> bytes:
+    return oyaml.dump(state, indent=4).encode('utf-8')
+
+
+def _load_yaml(data: bytes):
+    return oyaml.load(data, Loader=oyaml.Loader)
+
+
+def _dump_json(state) -> bytes:
+    return json.dumps(state, separators=(',', ':')).encode('utf-8')
+
+
+def _load_json(data: bytes):
+    return json.loads(data)
+
+
+def _dump_msgpack(state) -> bytes:
+    return msgpack.packb(state, use_bin_type=True)
+
+
+def _load_msgpack(data: bytes):
+    if msgpack is None:
+        raise ValueError("msgpack is not installed")
+    return msgpack.unpackb(data, raw=False)
+
+
+def _load_as(load, data):
+    try:
+        return load(data)
+    except Exception:
+        return None
+
+
+FORMATS = {
+    'yaml': (_dump_yaml, _load_yaml),
+    'json': (_dump_json, _load_json),
+    'msgpack': (_dump_msgpack, _load_msgpack),
+}
 
 
 class FilePersistencePlugin(PersistencePlugin):
@@ -11,21 +61,112 @@ class FilePersistencePlugin(PersistencePlugin):
     def __init__(self, opsbot):
         super().__init__(opsbot)
         self._path = self.read_config_value('path')
+        self._format = self.read_config_value('format', 'yaml')
+        if self._format not in FORMATS:
+            self.logger.critical(f"Unknown state file format '{self._format}'. Available: {', '.join(FORMATS)}")
+            exit(-1)
+        if self._format == 'msgpack' and msgpack is None:
+            self.logger.critical("State file format 'msgpack' requires the 'msgpack' package")
+            exit(-1)
+        self._dump, self._load = FORMATS[self._format]
+        self._journal_enabled = self.read_config_bool('journal')
+        self._journal_max_bytes = self.read_config_int('journal_max_bytes', 1024 * 1024)
+        self._journal = Journal(f"{self._path}.journal")
+        self._compacting_journal = Journal(f"{self._path}.journal.compacting")
+        self._journal_lock = threading.Lock()
+        self._compaction_lock = threading.Lock()
+        self._compaction_thread = None
 
     @staticmethod
     def required_configs():
         return ['path']
 
     def read_state(self) -> Dict:
+        state = self._read_snapshot()
+        replayed = 0
+        for journal in (self._compacting_journal, self._journal):
+            for record in journal.read():
+                set_path(state, record['path'], record['value'])
+                replayed += 1
+        if replayed:
+            self.logger.info(f"Replayed {replayed} journal records")
+            if not self._journal_enabled:
+                self.persist_state(state)
+            else:
+                self._compact_if_full()
+        return state
+
+    def _read_snapshot(self) -> Dict:
         if os.path.exists(self._path):
             self.logger.info(f"Load state from file '{self._path}'")
-            with open(self._path, 'r') as f:
-                return oyaml.load(f, Loader=oyaml.Loader)
+            with open(self._path, 'rb') as f:
+                data = f.read()
+            if not data:
+                return dict()
+            state = _load_as(self._load, data)
+            if isinstance(state, dict):
+                return state
+            for format_name, (_, load) in FORMATS.items():
+                state = _load_as(load, data) if format_name != self._format else None
+                if isinstance(state, dict):
+                    self.logger.info(f"Migrating state file '{self._path}' from {format_name} to {self._format}")
+                    write_atomic(self._path, self._dump(state))
+                    return state
+            raise ValueError(f"State file '{self._path}' has an unknown format")
         else:
             self.logger.warning(f"State file '{self._path}' not found")
             return dict()
 
     def persist_state(self, state):
         self.logger.info(f"Write state to file '{self._path}'")
-        with open(self._path, 'w') as f:
-            oyaml.dump(state, f, indent=4)
+        with self._compaction_lock, self._journal_lock:
+            data = self._dump(state)
+            write_atomic(self._path, data)
+            self._compacting_journal.remove()
+            self._journal.remove()
+        self._count_written_bytes(len(data))
+
+    def persist_keys(self, state, keys):
+        if not self._journal_enabled:
+            self.persist_state(state)
+            return
+        records = []
+        for path in sorted(keys):
+            value = get_path(state, path)
+            if value is not MISSING:
+                records.append(dict(path=list(path), value=value))
+        with self._journal_lock:
+            size = self._journal.append(records)
+        self._count_written_bytes(size)
+        self._compact_if_full()
+
+    def _compact_if_full(self):
+        with self._journal_lock:
+            if self._compaction_thread and self._compaction_thread.is_alive():
+                return
+            if not self._compacting_journal.exists():
+                if self._journal.size() < self._journal_max_bytes:
+                    return
+                # New records go to a fresh journal while the full one is folded into the snapshot
+                self._journal.rename(self._compacting_journal.path)
+            self._compaction_thread = threading.Thread(target=self._compact, name="journal-compaction", daemon=True)
+            self._compaction_thread.start()
+
+    def _compact(self):
+        """Writes a new snapshot from the old snapshot and the rotated journal. Does not touch the live state."""
+        try:
+            with self._compaction_lock:
+                if not self._compacting_journal.exists():
+                    return
+                state = self._read_snapshot()
+                records = 0
+                for record in self._compacting_journal.read():
+                    set_path(state, record['path'], record['value'])
+                    records += 1
+                data = self._dump(state)
+                write_atomic(self._path, data)
+                self._compacting_journal.remove()
+                self._count_written_bytes(len(data))
+                self.logger.info(f"Compacted {records} journal records into '{self._path}'")
+        except Exception:
+            self.logger.exception(f"Error while compacting the journal of '{self._path}'")
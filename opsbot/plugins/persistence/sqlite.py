@@ -0,0 +1,104 @@
+import json
+import sqlite3
+import threading
+from typing import Dict, List
+
+from . import PersistencePlugin
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bot_config (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS plugin_variables (
+    plugin_type TEXT NOT NULL,
+    plugin_name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (plugin_type, plugin_name, key)
+);
+"""
+
+_UPSERT_BOT_CONFIG = "INSERT INTO bot_config (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+_UPSERT_PLUGIN_VARIABLE = "INSERT INTO plugin_variables (plugin_type, plugin_name, key, value) VALUES (?, ?, ?, ?) " \
+                          "ON CONFLICT (plugin_type, plugin_name, key) DO UPDATE SET value = excluded.value"
+_DELETE_BOT_CONFIG = "DELETE FROM bot_config WHERE key = ?"
+_DELETE_PLUGIN_VARIABLE = "DELETE FROM plugin_variables WHERE plugin_type = ? AND plugin_name = ? AND key = ?"
+
+
+class SqlitePersistencePlugin(PersistencePlugin):
+    """
+    Stores every bot_config entry and every plugin variable in its own row, so a change only updates that row.
+    Rows of entries which are no longer in the state are deleted. The database runs in WAL mode.
+    """
+
+    def __init__(self, opsbot):
+        super().__init__(opsbot)
+        self._path = self.read_config_value('path')
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+
+    @staticmethod
+    def required_configs() -> List[str]:
+        return ['path']
+
+    def read_state(self) -> Dict:
+        self.logger.info(f"Load state from database '{self._path}'")
+        state = dict()
+        with self._lock:
+            bot_config = {key: json.loads(value) for key, value in self._connection.execute("SELECT key, value FROM bot_config")}
+            variables = self._connection.execute("SELECT plugin_type, plugin_name, key, value FROM plugin_variables").fetchall()
+        if bot_config:
+            state['bot_config'] = bot_config
+        for plugin_type, plugin_name, key, value in variables:
+            state.setdefault('plugins', dict()).setdefault(plugin_type, dict()).setdefault(plugin_name, dict())[key] = json.loads(value)
+        return state
+
+    def persist_state(self, state):
+        keys = [('bot_config', key) for key in state.get('bot_config', dict())]
+        for plugin_type, plugins in state.get('plugins', dict()).items():
+            for plugin_name, variables in plugins.items():
+                keys.extend(('plugins', plugin_type, plugin_name, key) for key in variables)
+        self._write(state, keys, replace=True)
+
+    def persist_keys(self, state, keys):
+        self._write(state, keys)
+
+    def _write(self, state, keys, replace=False):
+        """
+        Upserts the rows of the keys and deletes the rows of keys which were removed or set to None. With replace
+        all other rows are deleted as well.
+        """
+        bot_config_rows, variable_rows = [], []
+        removed_bot_config_rows, removed_variable_rows = [], []
+        for path in keys:
+            if len(path) == 2 and path[0] == 'bot_config':
+                value = state.get('bot_config', dict()).get(path[1])
+                if value is None:
+                    removed_bot_config_rows.append((path[1],))
+                else:
+                    bot_config_rows.append((path[1], json.dumps(value)))
+            elif len(path) == 4 and path[0] == 'plugins':
+                _, plugin_type, plugin_name, key = path
+                value = state.get('plugins', dict()).get(plugin_type, dict()).get(plugin_name, dict()).get(key)
+                if value is None:
+                    removed_variable_rows.append((plugin_type, plugin_name, key))
+                else:
+                    variable_rows.append((plugin_type, plugin_name, key, json.dumps(value)))
+            else:
+                self.logger.warning(f"Can not persist state entry {path}")
+        with self._lock:
+            with self._connection:
+                self._connection.execute("BEGIN")
+                if replace:
+                    self._connection.execute("DELETE FROM bot_config")
+                    self._connection.execute("DELETE FROM plugin_variables")
+                self._connection.executemany(_DELETE_BOT_CONFIG, removed_bot_config_rows)
+                self._connection.executemany(_DELETE_PLUGIN_VARIABLE, removed_variable_rows)
+                self._connection.executemany(_UPSERT_BOT_CONFIG, bot_config_rows)
+                self._connection.executemany(_UPSERT_PLUGIN_VARIABLE, variable_rows)
+        self._count_written_bytes(sum(len(row[-1]) for row in bot_config_rows + variable_rows))
+        self.logger.debug(f"Wrote {len(bot_config_rows) + len(variable_rows)} rows to database '{self._path}'")
@@ -1,18 +1,24 @@
 import importlib
 import logging
+import os
 import pkgutil
 import sys
+import threading
 from inspect import isclass, isabstract
-from typing import Dict, Type
+from typing import Dict, Optional, Type
 
 from . import OpsbotPlugin
 from .actions import ActionPlugin
+from .leader_election import LeaderElectionPlugin
 from .persistence import PersistencePlugin
-from ..config import get_config_value
+from ..config import ConfigSnapshot, get_config, get_config_list, get_config_value
 from ..config.constants import APP_DIR
 
 logger = logging.getLogger()
 
+# Config sections which are only read at startup
+RESTART_REQUIRED_CONFIGS = ['teams', 'server', 'persistence', 'leader_election', 'timezone', 'additional_plugin_dir']
+
 
 def _find_plugin_class_in_module(module, base_class):
     for i in dir(module):
@@ -25,10 +31,26 @@ def _find_plugin_class_in_module(module, base_class):
     raise PluginNotFoundException(f"No class extending '{base_class.__name__}' found in module '{module}'")
 
 
-def _find_plugin_classes(plugin_type, base_class):
+def _plugin_module_names(plugin_type):
+    """Lists the plugin modules of a type without importing them. The module name is the plugin name."""
     path = f"{APP_DIR}/plugins/{plugin_type}"
-    packages = pkgutil.iter_modules(path=[path])
-    modules = [importlib.import_module(f"opsbot.plugins.{plugin_type}.{name}") for (_, name, _) in packages]
+    return [name for (_, name, _) in pkgutil.iter_modules(path=[path])]
+
+
+def _active_plugin_names(plugin_type):
+    """Names of the plugins the config activates. Only these are imported."""
+    if plugin_type == 'actions':
+        deactivated = set(get_config_list('deactivate_plugins'))
+        return [name for name in _plugin_module_names(plugin_type) if name not in deactivated]
+    name = get_config_value(f"{plugin_type}.plugin")
+    return [name] if name in _plugin_module_names(plugin_type) else []
+
+
+def _find_plugin_classes(plugin_type, base_class, names=None):
+    """Imports the plugin modules with the given names, or all plugin modules of the type, and returns their classes."""
+    available = _plugin_module_names(plugin_type)
+    names = available if names is None else [name for name in names if name in available]
+    modules = [importlib.import_module(f"opsbot.plugins.{plugin_type}.{name}") for name in names]
     types = []
     for module in modules:
         try:
@@ -44,12 +66,37 @@ def _find_external_plugin_modules(path):
     return [importlib.import_module(name) for (_, name, _) in packages]
 
 
+def _external_module_name(path):
+    """Name of the external plugin module a file, given relative to additional_plugin_dir, belongs to."""
+    parts = path.split(os.sep)
+    if len(parts) > 1:
+        return parts[0]
+    name, extension = os.path.splitext(parts[0])
+    return name if extension == '.py' else None
+
+
+def _unload_module(name):
+    """Removes a module and its submodules from sys.modules. Returns the removed modules."""
+    return {m: sys.modules.pop(m) for m in list(sys.modules) if m == name or m.startswith(f"{name}.")}
+
+
+def _reimport_module(name):
+    """Imports a module and its submodules again from source. If that fails, the old modules are kept."""
+    old_modules = _unload_module(name)
+    importlib.invalidate_caches()
+    try:
+        return importlib.import_module(name)
+    except BaseException:
+        _unload_module(name)
+        sys.modules.update(old_modules)
+        raise
+
+
 def _are_required_configs_set(cls: Type[OpsbotPlugin], level):
     required_vars = [cls._config_key(c) for c in cls.required_configs()]
-    for required in required_vars:
-        if not get_config_value(required):
-            logger.log(level, f"{cls.__base__.__name__} '{cls.plugin_name()}' requires configurations: {required_vars}")
-            return False
+    if get_config().missing(required_vars):
+        logger.log(level, f"{cls.__base__.__name__} '{cls.plugin_name()}' requires configurations: {required_vars}")
+        return False
     return True
 
 
@@ -57,16 +104,22 @@ class PluginLoader(object):
 
     def __init__(self, opsbot):
         self._opsbot = opsbot
-        self._action_classes = _find_plugin_classes('actions', ActionPlugin)
-        persistence_classes = _find_plugin_classes('persistence', PersistencePlugin)
+        # The config and the plugin directory watchers reload plugins on their own threads
+        self._lock = threading.RLock()
+        self._action_classes = _find_plugin_classes('actions', ActionPlugin, _active_plugin_names('actions'))
+        persistence_classes = _find_plugin_classes('persistence', PersistencePlugin, _active_plugin_names('persistence'))
+        leader_election_classes = _find_plugin_classes('leader_election', LeaderElectionPlugin, _active_plugin_names('leader_election'))
 
+        self._external_actions = dict()
         external_plugin_path = get_config_value('additional_plugin_dir')
         if external_plugin_path:
             external_modules = _find_external_plugin_modules(external_plugin_path)
             for external_module in external_modules:
                 try:
                     try:
-                        self._action_classes.append(_find_plugin_class_in_module(external_module, ActionPlugin))
+                        action_class = _find_plugin_class_in_module(external_module, ActionPlugin)
+                        self._action_classes.append(action_class)
+                        self._external_actions[external_module.__name__] = action_class.plugin_name()
                         continue
                     except PluginNotFoundException:
                         pass
@@ -75,11 +128,17 @@ class PluginLoader(object):
                         continue
                     except PluginNotFoundException:
                         pass
+                    try:
+                        leader_election_classes.append(_find_plugin_class_in_module(external_module, LeaderElectionPlugin))
+                        continue
+                    except PluginNotFoundException:
+                        pass
                     logger.warning(f"Plugin could not be loaded. Has unknown type")
                 except Exception as e:
                     logger.warning(f"Plugin could not be loaded: {str(e)}")
 
         self._persistence = self._init_persistence_plugin(persistence_classes)
+        self._leader_election = self._init_leader_election_plugin(leader_election_classes)
         self._action_plugins = dict()
 
     def _init_persistence_plugin(self, persistence_classes):
@@ -94,18 +153,137 @@ class PluginLoader(object):
         logger.critical(f"Persistence plugin '{persistence_plugin_name}' not found.")
         exit(-1)
 
+    def _init_leader_election_plugin(self, leader_election_classes):
+        leader_election_plugin_name = get_config_value('leader_election.plugin')
+        if not leader_election_plugin_name:
+            return None
+        for leader_election_class in leader_election_classes:
+            if leader_election_class.plugin_name() == leader_election_plugin_name:
+                if not _are_required_configs_set(leader_election_class, logging.CRITICAL):
+                    exit(-1)
+                leader_election_plugin = leader_election_class(self._opsbot)
+                logger.info(f"Initialized leader election plugin '{leader_election_class.plugin_name()}'")
+                return leader_election_plugin
+        logger.critical(f"Leader election plugin '{leader_election_plugin_name}' not found.")
+        exit(-1)
+
     def init_action_plugins(self):
-        actions = dict()
+        with self._lock:
+            actions = dict()
+            deactivated = set(get_config_list('deactivate_plugins'))
+            for action_class in self._action_classes:
+                if action_class.plugin_name() not in deactivated:
+                    if _are_required_configs_set(action_class, logging.WARNING):
+                        action_plugin = action_class(self._opsbot)
+                        action_plugin.start()
+                        actions[action_class.plugin_name()] = action_plugin
+                        logger.info(f"Initialized action plugin '{action_class.plugin_name()}'")
+            self._action_plugins = actions
+
+    def reload_changed_action_plugins(self, old_config: ConfigSnapshot, new_config: ConfigSnapshot):
+        """Reloads the action plugins whose configuration or activation differs between the two configs."""
+        with self._lock:
+            for key in RESTART_REQUIRED_CONFIGS:
+                if old_config.get(key) != new_config.get(key):
+                    logger.warning(f"Configuration '{key}' changed. The change takes effect after a restart")
+            deactivated_before = set(old_config.get_list('deactivate_plugins'))
+            deactivated_now = set(new_config.get_list('deactivate_plugins'))
+            names = set(_plugin_module_names('actions')) | {action_class.plugin_name() for action_class in self._action_classes}
+            for name in sorted(names):
+                section = f"actions.{name}"
+                if (name in deactivated_before) != (name in deactivated_now) or old_config.get(section) != new_config.get(section):
+                    self.reload_action_plugin(name)
+
+    def reload_external_plugins(self, changed_paths):
+        """
+        Imports the external plugin modules with changed files (relative to additional_plugin_dir) again and
+        reloads their action plugins. A module which fails to import keeps its running version. Changes of
+        external persistence or leader election plugins take effect after a restart.
+        """
+        with self._lock:
+            external_plugin_path = get_config_value('additional_plugin_dir')
+            available = {name for (_, name, _) in pkgutil.iter_modules(path=[external_plugin_path])}
+            module_names = {_external_module_name(path) for path in changed_paths} - {None}
+            for module_name in sorted(module_names):
+                old_plugin_name = self._external_actions.get(module_name)
+                new_class = None
+                if module_name in available:
+                    try:
+                        new_class = _find_plugin_class_in_module(_reimport_module(module_name), ActionPlugin)
+                    except PluginNotFoundException:
+                        if not old_plugin_name:
+                            logger.warning(f"External plugin '{module_name}' changed. Only action plugins are reloaded, restart to apply the change")
+                            continue
+                    except Exception as e:
+                        logger.warning(f"External plugin '{module_name}' could not be reloaded. Keeping the running version: {str(e)}")
+                        continue
+                if old_plugin_name:
+                    self._action_classes = [c for c in self._action_classes if c.plugin_name() != old_plugin_name]
+                    del self._external_actions[module_name]
+                if new_class:
+                    self._action_classes.append(new_class)
+                    self._external_actions[module_name] = new_class.plugin_name()
+                else:
+                    _unload_module(module_name)
+                logger.info(f"External plugin module '{module_name}' {'reloaded' if new_class else 'removed'}")
+                for plugin_name in {old_plugin_name, new_class.plugin_name() if new_class else None} - {None}:
+                    self.reload_action_plugin(plugin_name)
+
+    def _action_class(self, name):
         for action_class in self._action_classes:
-            if action_class.plugin_name() not in get_config_value('deactivate_plugins', []):
-                if _are_required_configs_set(action_class, logging.WARNING):
-                    actions[action_class.plugin_name()] = action_class(self._opsbot)
-                    logger.info(f"Initialized action plugin '{action_class.plugin_name()}'")
-        self._action_plugins = actions
+            if action_class.plugin_name() == name:
+                return action_class
+        # Plugins which were deactivated at startup are imported when they get activated
+        action_classes = _find_plugin_classes('actions', ActionPlugin, [name])
+        self._action_classes.extend(action_classes)
+        return action_classes[0] if action_classes else None
+
+    def reload_action_plugin(self, name):
+        """
+        Creates a new instance of the action plugin with the current config and swaps it in. The new instance registers
+        its message hooks and jobs only after __init__ succeeded, and the running instance hands its message hooks
+        over to it at once, so no message is left without a hook. If the new instance fails or required configs are
+        missing, the running instance keeps working. Only plugins listed in deactivate_plugins or removed are shut down.
+        """
+        with self._lock:
+            old_plugin = self._action_plugins.get(name)
+            new_plugin = None
+            action_class = self._action_class(name) if name not in set(get_config_list('deactivate_plugins')) else None
+            if action_class:
+                if not _are_required_configs_set(action_class, logging.WARNING):
+                    if old_plugin:
+                        logger.warning(f"Could not reload action plugin '{name}'. Keeping the running instance")
+                    return
+                new_plugin = action_class.__new__(action_class)
+                try:
+                    # Invalid config values exit at startup, a reload keeps the running instance instead
+                    new_plugin.__init__(self._opsbot)
+                except (Exception, SystemExit):
+                    logger.exception(f"Could not reload action plugin '{name}'. Keeping the running instance")
+                    try:
+                        new_plugin.shutdown()
+                    except Exception:
+                        # Parts of the plugin which failed in __init__ may not exist
+                        self._opsbot.unregister_messagehooks(new_plugin)
+                    return
+                new_plugin.start()
+            if old_plugin:
+                old_plugin.shutdown(successor=new_plugin)
+            actions = dict(self._action_plugins)
+            if new_plugin:
+                actions[name] = new_plugin
+                logger.info(f"Reloaded action plugin '{name}'")
+            elif old_plugin:
+                del actions[name]
+                logger.info(f"Deactivated action plugin '{name}'")
+            self._action_plugins = actions
 
     def persistence(self) -> PersistencePlugin:
         return self._persistence
 
+    def leader_election(self) -> Optional[LeaderElectionPlugin]:
+        return self._leader_election
+
     def actions(self) -> Dict[str, ActionPlugin]:
         return self._action_plugins
 
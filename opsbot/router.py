@@ -0,0 +1,198 @@
+import re
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+REGEX = "REGEX"
+FUNC = "FUNC"
+
+_KEY_LENGTH = 3
+
+
+@dataclass(frozen=True, eq=False)
+class Hook:
+    priority: Tuple[int, int]
+    match_type: str
+    matcher: Any
+    function: Callable
+    keywords: Optional[FrozenSet[str]]
+    owner: Any = None
+
+
+def _required_keywords(parsed, ignore_case=False) -> Optional[FrozenSet[str]]:
+    """
+    Derives a set of literal strings from a parsed regex of which at least one occurs in every match.
+    Returns None if there is no such set, e.g. for patterns consisting only of wildcards or character classes.
+    """
+    options = []
+    run = []
+
+    def close_run():
+        if run:
+            options.append(frozenset(["".join(run)]))
+            run.clear()
+
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        close_run()
+        if op is sre_constants.SUBPATTERN:
+            sub_ignore_case = ignore_case or bool(av[1] & sre_constants.SRE_FLAG_IGNORECASE)
+            required = _required_keywords(av[-1], sub_ignore_case)
+        elif op is sre_constants.BRANCH:
+            branches = [_required_keywords(branch, ignore_case) for branch in av[1]]
+            required = frozenset().union(*branches) if all(branches) else None
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            required = _required_keywords(av[2], ignore_case)
+        else:
+            required = None
+        if required:
+            options.append(required)
+    close_run()
+    if not options:
+        return None
+    best = max(options, key=lambda keywords: min(len(k) for k in keywords))
+    return frozenset(k.lower() for k in best) if ignore_case else best
+
+
+def regex_keywords(regex) -> Optional[FrozenSet[str]]:
+    compiled = re.compile(regex)
+    return _required_keywords(sre_parse.parse(compiled.pattern, compiled.flags),
+                              bool(compiled.flags & re.IGNORECASE))
+
+
+class _CompiledRoutes(object):
+    """Immutable lookup structures built from the registered hooks."""
+
+    def __init__(self, hooks: List[Hook]):
+        self.unindexed: List[Hook] = []
+        self.hooks_by_keyword: Dict[str, List[Hook]] = defaultdict(list)
+        self.keywords_by_key: Dict[str, List[str]] = defaultdict(list)
+        self.short_keywords: Tuple[str, ...] = ()
+        short_keywords = []
+        for hook in hooks:
+            if not hook.keywords:
+                self.unindexed.append(hook)
+                continue
+            for keyword in hook.keywords:
+                if keyword not in self.hooks_by_keyword:
+                    if len(keyword) < _KEY_LENGTH:
+                        short_keywords.append(keyword)
+                    else:
+                        self.keywords_by_key[self._select_key(keyword)].append(keyword)
+                self.hooks_by_keyword[keyword].append(hook)
+        self.short_keywords = tuple(short_keywords)
+
+    def _select_key(self, keyword):
+        # Every substring of the text is looked up, so any part of the keyword can serve as key.
+        # Using the least used one keeps the buckets small for keywords with a common prefix.
+        keys = [keyword[i:i + _KEY_LENGTH] for i in range(len(keyword) - _KEY_LENGTH + 1)]
+        return min(keys, key=lambda k: len(self.keywords_by_key.get(k, ())))
+
+    def candidates(self, text) -> List[Hook]:
+        found = [k for k in self.short_keywords if k in text]
+        keywords_by_key = self.keywords_by_key
+        for i in range(len(text) - _KEY_LENGTH + 1):
+            for keyword in keywords_by_key.get(text[i:i + _KEY_LENGTH], ()):
+                if keyword not in found and keyword in text:
+                    found.append(keyword)
+        if not found:
+            return self.unindexed
+        if len(found) == 1 and not self.unindexed:
+            return self.hooks_by_keyword[found[0]]
+        hooks = set(self.unindexed)
+        for keyword in found:
+            hooks.update(self.hooks_by_keyword[keyword])
+        return sorted(hooks, key=lambda h: h.priority)
+
+
+class CommandRouter(object):
+    """
+    Finds the message hook for a message text. The text is lower-cased once. Regex hooks are indexed by the
+    literal keywords their pattern requires (keyed by a three character part of the keyword), so only hooks whose
+    keyword occurs in the text are evaluated. Hooks are tried in registration order and the first match wins,
+    just like a linear scan over all hooks.
+    Hooks can be registered for an owner, e.g. a plugin. All hooks of an owner rank at the position of its first
+    hook, and can be removed together or handed over to a successor which then takes over that position.
+    """
+
+    def __init__(self):
+        self._hooks: List[Hook] = []
+        self._unknown: Optional[Callable] = None
+        self._unknown_owner = None
+        self._replaced_unknown = (None, None)
+        self._owner_ranks: Dict[Any, int] = dict()
+        self._sequence = 0
+        self._compiled: Optional[_CompiledRoutes] = None
+        self._lock = threading.Lock()
+
+    def add_regex(self, regex, function, owner=None):
+        self._add(REGEX, re.compile(regex), function, regex_keywords(regex), owner)
+
+    def add_func(self, matcher_func, function, owner=None):
+        self._add(FUNC, matcher_func, function, None, owner)
+
+    def set_unknown(self, function, owner=None):
+        """Sets the hook for messages no other hook matches. The replaced one comes back if the owner is removed."""
+        with self._lock:
+            if self._unknown_owner is not owner:
+                self._replaced_unknown = (self._unknown, self._unknown_owner)
+            self._unknown = function
+            self._unknown_owner = owner
+
+    def _add(self, match_type, matcher, function, keywords, owner):
+        with self._lock:
+            sequence = self._sequence
+            self._sequence += 1
+            rank = sequence if owner is None else self._owner_ranks.setdefault(owner, sequence)
+            self._hooks.append(Hook((rank, sequence), match_type, matcher, function, keywords, owner))
+            self._compiled = None
+
+    def remove_owner(self, owner, successor=None):
+        """
+        Removes all hooks of the owner. If a successor is given, its hooks move to the position of the owner's hooks.
+        Both happens at once, so messages are routed either to the old or to the new hooks. If the owner set the
+        unknown hook without a successor taking it over, the unknown hook it replaced is restored.
+        """
+        with self._lock:
+            rank = self._owner_ranks.pop(owner, None)
+            hooks = [hook for hook in self._hooks if hook.owner is not owner]
+            if successor is not None and rank is not None:
+                self._owner_ranks[successor] = rank
+                hooks = [replace(hook, priority=(rank, hook.priority[1])) if hook.owner is successor else hook
+                         for hook in hooks]
+            self._hooks = hooks
+            if self._replaced_unknown[1] is owner:
+                self._replaced_unknown = (None, None)
+            if self._unknown_owner is owner:
+                self._unknown, self._unknown_owner = self._replaced_unknown
+                self._replaced_unknown = (None, None)
+            self._compiled = None
+
+    def _routes(self) -> _CompiledRoutes:
+        compiled = self._compiled
+        if compiled is None:
+            with self._lock:
+                if self._compiled is None:
+                    self._compiled = _CompiledRoutes(sorted(self._hooks, key=lambda h: h.priority))
+                compiled = self._compiled
+        return compiled
+
+    def find(self, text) -> Optional[Callable]:
+        """Returns the function of the first matching hook, the unknown hook or None."""
+        normalized = text.lower()
+        for hook in self._routes().candidates(normalized):
+            if hook.match_type == REGEX:
+                if hook.matcher.search(normalized):
+                    return hook.function
+            elif hook.matcher(text):
+                return hook.function
+        return self._unknown
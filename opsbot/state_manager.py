@@ -0,0 +1,151 @@
+import copy
+import logging
+import threading
+
+from . import metrics
+from .utils.state_paths import MISSING, get_path, replace_path
+
+logger = logging.getLogger()
+
+
+def _normalized(value):
+    """
+    Returns a copy of the value with lists instead of tuples, like it comes back from YAML, JSON or msgpack.
+    Otherwise a value containing tuples would never equal its persisted version.
+    """
+    if isinstance(value, dict):
+        return {key: _normalized(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalized(item) for item in value]
+    return copy.deepcopy(value)
+
+
+class StateManager(object):
+    """
+    Tracks which entries of the bot state changed and coalesces writes to the persistence plugin.
+    Entries are addressed by key paths like ("bot_config", "user_map") or ("plugins", "actions", "jira", "issues").
+    A value is only marked dirty if it differs from the last persisted value. Dirty entries are written together
+    after the debounce window. Values are copied when they are set or read, with lists instead of tuples, and a
+    change replaces the dicts on its path instead of modifying them. A write therefore works on the state as of its
+    start and does not block readers and writers while the persistence plugin is busy.
+    """
+
+    def __init__(self, persistence, state, debounce=1.0):
+        self._persistence = persistence
+        self._persist_keys = metrics.instrument(persistence.persist_keys, metrics.PERSISTENCE_DURATION,
+                                                metrics.PERSISTENCE_WRITES, plugin=persistence.plugin_name())
+        self._state = _normalized(state)
+        self._persisted = self._state
+        self._debounce = debounce
+        self._dirty = set()
+        self._flushing = set()
+        self._timer = None
+        self._lock = threading.RLock()
+        # Keeps the writes in order. Taken before self._lock and never while holding it
+        self._write_lock = threading.Lock()
+        self._updates = 0
+        self._writes = 0
+
+    def get(self, path, default=None):
+        """Returns a copy of the value at the path or default if there is none."""
+        with self._lock:
+            value = get_path(self._state, path)
+        return default if value is MISSING else copy.deepcopy(value)
+
+    def set(self, path, value):
+        """Stores a copy of the value in the state and schedules a write if it changed since the last write."""
+        if self._set(tuple(path), _normalized(value)) and self._debounce <= 0:
+            self.flush()
+
+    def update(self, path, func, default=None):
+        """
+        Replaces the value at the path with func(value). func gets a copy of the current value or default and runs
+        while holding the lock, so concurrent updates of the same value are not lost.
+        """
+        with self._lock:
+            value = get_path(self._state, path)
+            value = _normalized(func(copy.deepcopy(default if value is MISSING else value)))
+            changed = self._set(tuple(path), value)
+        if changed and self._debounce <= 0:
+            self.flush()
+
+    def _set(self, path, value):
+        """Stores the value and marks it dirty. Returns whether it differs from the persisted value."""
+        with self._lock:
+            self._updates += 1
+            self._state = replace_path(self._state, path, value)
+            if get_path(self._persisted, path) == value:
+                self._dirty.discard(path)
+                return False
+            self._dirty.add(path)
+            if self._debounce > 0:
+                self._schedule_flush()
+            return True
+
+    def _schedule_flush(self):
+        if not self._timer:
+            self._timer = threading.Timer(self._debounce, self._scheduled_flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Writes the state if there are dirty entries."""
+        with self._write_lock:
+            with self._lock:
+                if self._timer:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                dirty, self._dirty = self._dirty, set()
+                # Remote changes applied while writing, e.g. after a conflict, must keep these entries as well
+                self._flushing = dirty
+                state = self._state
+            try:
+                self._persist_keys(state, dirty)
+            except Exception:
+                with self._lock:
+                    self._dirty.update(dirty)
+                    self._flushing = set()
+                raise
+            with self._lock:
+                self._flushing = set()
+                for path in dirty:
+                    written = get_path(state, path)
+                    self._persisted = replace_path(self._persisted, path, written)
+                    if get_path(self._state, path) != written:
+                        # Changed again while writing
+                        self._dirty.add(path)
+                        self._schedule_flush()
+                self._writes += 1
+                logger.debug(f"Persisted {len(dirty)} changed entries. {self.stats()['writes_avoided']} writes avoided so far")
+
+    def apply_remote(self, path, value):
+        """
+        Takes over a value another replica persisted. Local changes below the path which were not written yet
+        are kept, so they are not lost and still get written with the next flush.
+        """
+        path = tuple(path)
+        value = _normalized(value)
+        with self._lock:
+            pending = {dirty: get_path(self._state, dirty) for dirty in self._dirty | self._flushing
+                       if dirty[:len(path)] == path}
+            state = replace_path(self._state, path, value)
+            self._persisted = replace_path(self._persisted, path, value)
+            for dirty, local_value in pending.items():
+                if local_value is not MISSING:
+                    state = replace_path(state, dirty, local_value)
+            self._state = state
+
+    def _scheduled_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Error while persisting state. Retrying after the debounce window")
+            with self._lock:
+                self._schedule_flush()
+
+    def stats(self):
+        with self._lock:
+            return dict(updates=self._updates, writes=self._writes, writes_avoided=self._updates - self._writes,
+                        dirty=len(self._dirty | self._flushing))
@@ -1,16 +1,22 @@
 # coding=utf-8
-import asyncio
+import atexit
+import functools
 import logging
-import re
 import traceback
+from concurrent.futures import Future
 
 from botbuilder.schema import Activity, ActivityTypes, ChannelAccount, Mention, ConversationAccount
-from botframework.connector import ConnectorClient
-from botframework.connector.auth import MicrosoftAppCredentials, JwtTokenValidation, SimpleCredentialProvider
-from flask import Flask, request
-
-from .config import get_config_value
+from flask import Flask, Response, request
+
+from . import metrics
+from .auth import AuthenticationError, TokenValidator
+from .config import get_config_bool, get_config_float, get_config_int, get_config_value
+from .connector_pool import ConnectorPool
+from .handler_pool import HandlerPool
+from .outbound_queue import OutboundQueue
 from .plugins.plugin_loader import PluginLoader
+from .router import CommandRouter
+from .state_manager import StateManager
 
 logger = logging.getLogger()
 
@@ -18,49 +24,70 @@ logger = logging.getLogger()
 class TeamsBot(object):
     def __init__(self, name):
         self.name = name
-        self._messagehook_unknown = None
-        self._messagehooks = list()
+        self._router = CommandRouter()
         self._app_id = get_config_value('teams.app_id', fail_if_missing=True)
         self._app_password = get_config_value('teams.app_password', fail_if_missing=True)
+        self._skip_authentication = get_config_bool('teams.skip_authentication')
+        self._token_validator = TokenValidator(self._app_id)
+        if not self._skip_authentication:
+            self._token_validator.start()
+        self._connector_pool = ConnectorPool(self._app_id, self._app_password)
+        self._outbound_queue = OutboundQueue(self._instrumented_send(self._send_activity),
+                                             concurrency=get_config_int('teams.send_concurrency', 4),
+                                             max_retries=get_config_int('teams.send_max_retries', 5))
+        atexit.register(self._outbound_queue.shutdown)
+        self._handler_pool = HandlerPool(max_workers=get_config_int('server.handler_workers', 8),
+                                         max_queue=get_config_int('server.handler_queue_size', 100),
+                                         timeout=get_config_float('server.handler_timeout', 120))
         self.plugins = PluginLoader(self)
-        self._config = self.plugins.persistence().read_state()
-        bot_config = self._config.get("bot_config", dict())
-        self._service_url = bot_config.get("service_url")
-        self._conversations = bot_config.get("conversations", dict())
-        self._current_channel = bot_config.get("current_channel")
-        self._current_bot_id = bot_config.get("current_bot_id")
-        self._channel_data = bot_config.get("channel_data")
-        self._user_map = bot_config.get("user_map", dict())
-        self._conversation_channels = bot_config.get("conversation_channels", dict())
+        self._state_manager = StateManager(self.plugins.persistence(), self.plugins.persistence().read_state(),
+                                           debounce=get_config_float('persistence.debounce_seconds', 1))
+        atexit.register(self._state_manager.flush)
+        self.plugins.persistence().watch(self._state_changed_remotely)
         self._init_routes()
 
+    def _bot_config(self, key, default=None):
+        return self._state_manager.get(("bot_config", key), default)
+
+    def _set_bot_config(self, key, value):
+        self._state_manager.set(("bot_config", key), value)
+
+    def _state_changed_remotely(self, path, value):
+        self._state_manager.apply_remote(path, value)
+
     def _init_routes(self):
         self._flask_app = Flask(__name__)
         self._flask_app.add_url_rule('/api/message', "message", self.message_received, methods=['POST'])
         self._flask_app.add_url_rule('/health', "health", self.health, methods=['GET'])
+        self._flask_app.add_url_rule('/metrics', "metrics", self.metrics_page, methods=['GET'])
         self._flask_app.add_url_rule('/', "index", self.index_page, methods=['GET'])
 
     def _register_conversation(self, conversation, conversation_type):
-        self._conversations[conversation_type] = conversation.__dict__["id"].split(";")[0]
+        conversation_id = conversation.__dict__["id"].split(";")[0]
+        self._state_manager.update(("bot_config", "conversations"),
+                                   lambda conversations: dict(conversations, **{conversation_type: conversation_id}), dict())
 
-    def send_reply(self, text, reply_to, mentions=None):
-        self.__send(text, reply_to.conversation, mentions)
+    def send_reply(self, text, reply_to, mentions=None) -> Future:
+        return self.__send(text, reply_to.conversation, mentions)
 
-    def send_message(self, text, channel_type, mentions=None):
-        if channel_type in self._conversation_channels:
-            channel_id = self._conversation_channels[channel_type]
+    def send_message(self, text, channel_type, mentions=None) -> Future:
+        conversation_channels = self._bot_config("conversation_channels", dict())
+        if channel_type in conversation_channels:
+            channel_id = conversation_channels[channel_type]
         else:
-            channel_id = self._channel_data['channel']['id']
+            channel_id = self._bot_config("channel_data")['channel']['id']
         conversation = ConversationAccount(is_group=True, id=channel_id, conversation_type="channel")
-        self.__send(text, conversation, mentions)
+        return self.__send(text, conversation, mentions)
 
     def __send(self, text, conversation, mentions=None):
-        logger.info(f"Sending message: {text}")
+        """ queues the message for sending and returns a future for the send result """
+        logger.info(f"Queueing message: {text}")
         entities = list()
         if mentions is None:
             mentions = list()
+        user_map = self._bot_config("user_map", dict()) if mentions else dict()
         for name in mentions:
-            user_id = self._user_map.get(name)
+            user_id = user_map.get(name)
             if not user_id:
                 logger.info("User not found: %s" % name)
                 continue
@@ -68,76 +95,74 @@ class TeamsBot(object):
                               type="mention")
             entities.append(mention)
 
-        credentials = MicrosoftAppCredentials(self._app_id, self._app_password)
-        connector = ConnectorClient(credentials, base_url=self._service_url)
-
+        current_bot_id = self._bot_config("current_bot_id")
         reply = Activity(
             type=ActivityTypes.message,
-            channel_id=self._current_channel,
+            channel_id=self._bot_config("current_channel"),
             conversation=conversation,
-            from_property=ChannelAccount(id=self._current_bot_id["id"], name=self._current_bot_id["name"]),
+            from_property=ChannelAccount(id=current_bot_id["id"], name=current_bot_id["name"]),
             entities=entities,
             text=text,
-            service_url=self._service_url)
+            service_url=self._bot_config("service_url"))
 
-        response = connector.conversations.send_to_conversation(reply.conversation.id, reply)
+        return self._outbound_queue.submit(reply.conversation.id, reply)
+
+    def _send_activity(self, conversation_id, activity):
+        connector = self._connector_pool.get(activity.service_url)
+        response = connector.conversations.send_to_conversation(conversation_id, activity)
         logger.info(response)
+        return response
 
     def message_received(self):
+        """ handles incoming messages of the flask app """
+        body = request.get_json(silent=True)
+        return "", self.accept_activity(body, request.headers.get("Authorization"))
+
+    def accept_activity(self, body, authorization):
+        """ validates an incoming activity and hands it over to the handler pool. Returns the HTTP status code """
+        if not body:
+            return 400
+        logger.info(f"Received message: \n {body}")
+        activity = Activity.deserialize(body)
+        if not self._skip_authentication:
+            try:
+                self._token_validator.validate(authorization, activity)
+            except AuthenticationError as e:
+                logger.info(f"Authorization failed. Not processing request: {str(e)}")
+                return 401
+            except Exception:
+                logger.exception("Could not validate authorization. Not processing request")
+                return 503
+        if not self._handler_pool.submit(self._process_activity, activity, on_timeout=lambda: self._handler_timed_out(activity)):
+            logger.warning(f"Handler queue is full. Rejecting activity '{activity.id}'")
+            return 503
+        return 200
+
+    def _process_activity(self, activity):
         """ handles incoming messages """
-        logger.info(f"Received message: \n {request.get_json()}")
-        activity = Activity.deserialize(request.get_json())
-        authorization = request.headers.get("Authorization")
-
-        # if not self._handle_authentication(authorization, activity):
-        #    logger.info("Authorization failed. Not processing request")
-        #    return ""
-        self._service_url = activity.service_url
         try:
+            self._set_bot_config("service_url", activity.service_url)
             if activity.type == ActivityTypes.message.value:
                 self._update_user_map(activity)
                 mentions = self._extract_mentions(activity)
-                message_text = activity.text
-                matched = False
-                for match_type, matcher, func in self._messagehooks:
-                    if match_type == "REGEX":
-                        if matcher.findall(message_text.lower()):
-                            func(activity, mentions)
-                            matched = True
-                            break
-                    elif match_type == "FUNC":
-                        if matcher(message_text):
-                            func(activity, mentions)
-                            matched = True
-                            break
-                if not matched and self._messagehook_unknown:
-                    self._messagehook_unknown(activity, mentions)
-            self._save_system_config()
+                func = self._router.find(activity.text)
+                if func:
+                    func(activity, mentions)
         except Exception as e:
             traceback.print_exc()
             try:
                 self.send_reply("Es ist ein Fehler aufgetreten: %s" % e, reply_to=activity)
             except:
                 traceback.print_exc()
-        return ""
 
-    def _handle_authentication(self, authorization, activity):
-        credential_provider = SimpleCredentialProvider(self._app_id, self._app_password)
-        loop = asyncio.new_event_loop()
-        try:
-            loop.run_until_complete(JwtTokenValidation.assert_valid_activity(
-                activity, authorization, credential_provider))
-            return True
-        except Exception as ex:
-            logger.info(ex)
-            return False
-        finally:
-            loop.close()
+    def _handler_timed_out(self, activity):
+        if activity.type == ActivityTypes.message.value:
+            self.send_reply("Das dauert leider länger als erwartet. Ich melde mich, sobald ich fertig bin.", reply_to=activity)
 
     def _update_bot_infos(self, activity):
-        self._current_channel = activity.channel_id
-        self._current_bot_id = activity.recipient.__dict__
-        self._channel_data = activity.channel_data
+        self._set_bot_config("current_channel", activity.channel_id)
+        self._set_bot_config("current_bot_id", activity.recipient.__dict__)
+        self._set_bot_config("channel_data", activity.channel_data)
 
     def _extract_mentions(self, activity):
         mentions = list()
@@ -152,26 +177,54 @@ class TeamsBot(object):
         return mentions
 
     def _update_user_map(self, activity):
+        users = dict()
         for mention in activity.entities:
             if mention.type == "mention":
                 mentioned = mention.__dict__["additional_properties"]["mentioned"]
                 user_id = mentioned["id"]
                 name = mentioned["name"]
-                self._user_map[name] = user_id
+                users[name] = user_id
         mentioned = activity.from_property.__dict__
         user_id = mentioned["id"]
         name = mentioned["name"]
-        self._user_map[name] = user_id
+        users[name] = user_id
+        # Almost every activity comes from known users, only copy the user map if one is new or changed
+        if any(self._state_manager.get(("bot_config", "user_map", name)) != user_id for name, user_id in users.items()):
+            self._state_manager.update(("bot_config", "user_map"), lambda user_map: dict(user_map, **users), dict())
+
+    def register_messagehook_regex(self, regex, message_func, owner=None, run_with=None):
+        self._router.add_regex(regex, self._instrumented_hook(regex, message_func, owner, run_with), owner)
 
-    def register_messagehook_regex(self, regex, message_func):
-        regex_matcher = re.compile(regex)
-        self._messagehooks.append(("REGEX", regex_matcher, message_func))
+    def register_messagehook_func(self, matcher_func, message_func, owner=None, run_with=None):
+        command = getattr(matcher_func, '__name__', str(matcher_func))
+        self._router.add_func(matcher_func, self._instrumented_hook(command, message_func, owner, run_with), owner)
 
-    def register_messagehook_func(self, matcher_func, message_func):
-        self._messagehooks.append(("FUNC", matcher_func, message_func))
+    def register_messagehook_unknown(self, message_func, owner=None, run_with=None):
+        self._router.set_unknown(self._instrumented_hook("unknown", message_func, owner, run_with), owner)
 
-    def register_messagehook_unknown(self, message_func):
-        self._messagehook_unknown = message_func
+    @staticmethod
+    def _instrumented_hook(command, message_func, owner, run_with):
+        """
+        Records count and duration of the hook per command and owner. If given, run_with(func, activity, mentions)
+        runs the measured hook, e.g. on the executor of a plugin.
+        """
+        measured = metrics.instrument(message_func, metrics.COMMAND_DURATION, metrics.COMMANDS,
+                                      plugin=metrics.owner_name(owner), command=command)
+        if run_with is None:
+            return measured
+
+        @functools.wraps(message_func)
+        def run(activity, mentions):
+            run_with(measured, activity, mentions)
+
+        return run
+
+    @staticmethod
+    def _instrumented_send(send_func):
+        return metrics.instrument(send_func, metrics.SEND_DURATION, metrics.SENDS)
+
+    def unregister_messagehooks(self, owner, successor=None):
+        self._router.remove_owner(owner, successor)
 
     def messagehook_regex(self, regex):
         def decorator(message_func):
@@ -197,26 +250,39 @@ class TeamsBot(object):
         else:
             return decorator
 
-    def _save_system_config(self):
-        bot_config = dict()
-        bot_config["service_url"] = self._service_url
-        bot_config["conversations"] = self._conversations
-        bot_config["current_channel"] = self._current_channel
-        bot_config["current_bot_id"] = self._current_bot_id
-        bot_config["channel_data"] = self._channel_data
-        bot_config["user_map"] = self._user_map
-        bot_config["conversation_channels"] = self._conversation_channels
-        self._config["bot_config"] = bot_config
-        self.plugins.persistence().persist_state(self._config)
+    def state_stats(self):
+        return self._state_manager.stats()
 
     def health(self):
         return "OK"
 
+    def metrics_page(self):
+        content, content_type = metrics.exposition()
+        return Response(content, content_type=content_type)
+
     def index_page(self):
         return "This is Opsbot"
 
+    def connector_stats(self):
+        return self._connector_pool.stats()
+
+    def connector_credentials(self):
+        return self._connector_pool.credentials()
+
     def get_app(self):
         return self._flask_app
 
+    def set_send_transport(self, send_func):
+        """ replaces the function used by the outbound queue to deliver activities """
+        self._outbound_queue.set_send_func(self._instrumented_send(send_func or self._send_activity))
+
     def run(self, port=5000, debug=False):
-        self._flask_app.run(host='0.0.0.0', port=port, debug=debug, threaded=True)
+        server_mode = get_config_value('server.mode', 'flask')
+        if server_mode == 'aiohttp':
+            from .aiohttp_server import AiohttpServer
+            AiohttpServer(self).run(port=port)
+        elif server_mode == 'flask':
+            self._flask_app.run(host='0.0.0.0', port=port, debug=debug, threaded=True)
+        else:
+            logger.critical(f"Unknown server mode '{server_mode}'")
+            exit(-1)
@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive failures of calls to a backend. After failure_threshold failures the circuit opens and
+    calls fail immediately with CircuitOpenError instead of waiting for the backend. After reset_timeout seconds
+    the circuit is half open and allow() lets a single probe through, other calls are rejected until it finished:
+    a success closes the circuit, a failure opens it for another reset_timeout. A probe without outcome after
+    reset_timeout is given up, so another one can be made.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60.0):
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            self._update_state()
+            return self._state
+
+    def _update_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self._reset_timeout:
+            self._state = HALF_OPEN
+
+    def allow(self) -> bool:
+        """
+        Returns whether a call may be made. While the circuit is half open only the probe is allowed, its outcome must
+        be recorded or the probe cancelled. Counts the rejected calls.
+        """
+        with self._lock:
+            self._update_state()
+            if self._state == HALF_OPEN:
+                now = time.monotonic()
+                if self._probe_started is None or now - self._probe_started >= self._reset_timeout:
+                    self._probe_started = now
+                    return True
+            if self._state != CLOSED:
+                self._rejected += 1
+                return False
+            return True
+
+    def cancel(self):
+        """Gives up the probe allow() admitted if the call was not made, e.g. because the executor was full"""
+        with self._lock:
+            self._probe_started = None
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info(f"Circuit '{self._name}' is closed again")
+            self._state = CLOSED
+            self._failures = 0
+            self._probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self._update_state()
+            self._failures += 1
+            self._probe_started = None
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self._failure_threshold):
+                logger.warning(f"Circuit '{self._name}' is open after {self._failures} failures. "
+                               f"Failing fast for {self._reset_timeout}s")
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func and records the outcome. Raises CircuitOpenError without calling func if the circuit is open.
+        While it is half open func is called, as the calls are made by the probe allow() admitted.
+        """
+        with self._lock:
+            self._update_state()
+            if self._state == OPEN:
+                self._rejected += 1
+                raise CircuitOpenError(f"'{self._name}' is currently unavailable")
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def stats(self):
+        with self._lock:
+            self._update_state()
+            return dict(state=self._state, failures=self._failures, rejected=self._rejected)
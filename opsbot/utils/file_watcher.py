@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger()
+
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _directory_signatures(directory):
+    signatures = dict()
+    for root, dirs, files in os.walk(directory, followlinks=True):
+        # Skip hidden entries like the '..data' directory of a mounted ConfigMap and byte code caches
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != '__pycache__']
+        for name in files:
+            if not name.startswith('.'):
+                path = os.path.join(root, name)
+                signature = _file_signature(path)
+                if signature is not None:
+                    signatures[os.path.relpath(path, directory)] = signature
+    return signatures
+
+
+class FileWatcher(object):
+    """
+    Polls the modification time, size and inode of a file and calls callback(path) after it changed. Replacing
+    the file (e.g. the symlink swap of a mounted Kubernetes ConfigMap) counts as change. While the file does
+    not exist, nothing is reported.
+    """
+
+    def __init__(self, path, callback, interval=5.0):
+        self._path = path
+        self._callback = callback
+        self._interval = interval
+        self._signature = _file_signature(path)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"file-watcher-{os.path.basename(path)}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def check(self):
+        """Calls the callback if the file changed since the last check. Returns whether it changed."""
+        signature = _file_signature(self._path)
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            self._callback(self._path)
+        except Exception:
+            logger.exception(f"Error while handling change of '{self._path}'")
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.check()
+
+
+class DirectoryWatcher(FileWatcher):
+    """
+    Polls all files below a directory and calls callback(paths) with the relative paths of the files which were
+    added, changed or removed since the last check.
+    """
+
+    def __init__(self, directory, callback, interval=5.0):
+        super().__init__(directory, callback, interval)
+        self._signature = _directory_signatures(directory)
+
+    def check(self):
+        signatures = _directory_signatures(self._path)
+        changed = {path for path in set(signatures) | set(self._signature)
+                   if signatures.get(path) != self._signature.get(path)}
+        if not changed:
+            return False
+        self._signature = signatures
+        try:
+            self._callback(changed)
+        except Exception:
+            logger.exception(f"Error while handling changes in '{self._path}'")
+        return True
@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger()
+
+
+class JiraError(Exception):
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class JiraClient(object):
+    """
+    Client for the Jira REST API. All requests share one session, so connections are kept alive and reused, and
+    every request has a timeout. The JQL of a filter rarely changes and is cached for filter_cache_ttl seconds.
+    Requests go through call(func), e.g. the circuit breaker of a plugin. Only unreachable servers and server
+    errors raise there, client errors are reported as JiraError by the methods.
+    Search results are read page by page, the next page is fetched in the background while the current one is
+    processed. Issues are created in bulk. If the bulk endpoint is not available, up to pool_size issues are created
+    concurrently instead.
+    """
+
+    def __init__(self, base_url, auth, timeout=10.0, filter_cache_ttl=3600.0, pool_size=4, call=None):
+        self._base_url = base_url.rstrip('/')
+        self._timeout = timeout
+        self._filter_cache_ttl = filter_cache_ttl
+        self._call = call or (lambda func: func())
+        self._session = requests.Session()
+        self._session.auth = auth
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._filter_cache: Dict[str, tuple] = dict()
+        self._filter_cache_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="jira")
+        self._bulk_supported = True
+
+    def request(self, method, path, **kwargs) -> requests.Response:
+        """Sends a request to the REST API. path is relative to the base url, e.g. '/rest/api/2/issue/XXX-1'"""
+        def send():
+            response = self._session.request(method, self._base_url + path, timeout=self._timeout, **kwargs)
+            if response.status_code >= 500:
+                response.raise_for_status()
+            return response
+
+        return self._call(send)
+
+    def filter_jql(self, filter_id) -> str:
+        filter_id = str(filter_id)
+        with self._filter_cache_lock:
+            cached = self._filter_cache.get(filter_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        response = self.request("GET", f"/rest/api/2/filter/{filter_id}")
+        if not response.ok:
+            raise JiraError(f"Failed to get filter {filter_id}: {response.status_code} {response.text}", response.status_code)
+        jql = response.json()["jql"]
+        with self._filter_cache_lock:
+            self._filter_cache[filter_id] = (jql, time.monotonic() + self._filter_cache_ttl)
+        return jql
+
+    def search(self, jql, fields: Optional[List[str]] = None, page_size=100, max_results=None,
+               validate_query=None, on_truncated: Optional[Callable[[int], None]] = None) -> Iterator[Dict]:
+        """
+        Yields the issues matching the jql. Pages of page_size issues are requested with startAt/maxResults until
+        all issues or max_results issues are read. Jira may return smaller pages than requested.
+        validate_query is passed as validateQuery (strict, warn or none). If more than max_results issues match,
+        on_truncated is called with the total number of matching issues.
+        """
+        params = dict(jql=jql)
+        if fields is not None:
+            params['fields'] = ','.join(fields)
+        if validate_query:
+            params['validateQuery'] = validate_query
+        read = 0
+        page = self._search_page(params, 0, page_size if max_results is None else min(page_size, max_results))
+        while page is not None:
+            issues = page["issues"]
+            start_at = page.get("startAt", read) + len(issues)
+            total = page.get("total", start_at)
+            if max_results is not None and len(issues) > max_results - read:
+                issues = issues[:max_results - read]
+            read += len(issues)
+            next_page = None
+            if issues and start_at < total:
+                if max_results is None or read < max_results:
+                    size = page_size if max_results is None else min(page_size, max_results - read)
+                    next_page = self._executor.submit(self._search_page, params, start_at, size)
+                else:
+                    logger.warning(f"Search '{jql}' found {total} issues. Only the first {max_results} are read")
+                    if on_truncated:
+                        on_truncated(total)
+            yield from issues
+            page = next_page.result() if next_page else None
+
+    def _search_page(self, params, start_at, max_results) -> Dict:
+        response = self.request("GET", "/rest/api/2/search", params=dict(params, startAt=start_at, maxResults=max_results))
+        if not response.ok:
+            raise JiraError(f"Failed to search issues: {response.status_code} {response.text}", response.status_code)
+        return response.json()
+
+    def get_issue(self, key, fields: Optional[List[str]] = None) -> Dict:
+        params = dict(fields=','.join(fields)) if fields is not None else None
+        response = self.request("GET", f"/rest/api/2/issue/{key}", params=params)
+        if not response.ok:
+            raise JiraError(f"Failed to get ticket {key}: {response.status_code} {response.text}", response.status_code)
+        return response.json()
+
+    def create_issue(self, fields: Dict) -> Dict:
+        response = self.request("POST", "/rest/api/2/issue/", json=dict(fields=fields))
+        if not response.ok:
+            raise JiraError(f"Failed to create subtask: {response.status_code} {response.text}", response.status_code)
+        return response.json()
+
+    def create_issues(self, issue_fields: List[Dict], chunk_size=50) -> Iterator[List[Tuple[Optional[str], Optional[str]]]]:
+        """
+        Creates the issues in chunks of chunk_size and yields a list per chunk with (key, None) for every created
+        and (None, error) for every failed issue, in the order of issue_fields.
+        """
+        for i in range(0, len(issue_fields), chunk_size):
+            chunk = issue_fields[i:i + chunk_size]
+            if self._bulk_supported:
+                try:
+                    yield self._create_bulk(chunk)
+                    continue
+                except JiraError as e:
+                    if e.status_code not in (404, 405):
+                        raise
+                    logger.info("Jira does not support bulk creation of issues. Creating them one by one")
+                    self._bulk_supported = False
+            yield list(self._executor.map(self._create_one, chunk))
+
+    def _create_bulk(self, chunk):
+        response = self.request("POST", "/rest/api/2/issue/bulk", json=dict(issueUpdates=[dict(fields=f) for f in chunk]))
+        if response.status_code in (404, 405) or (not response.ok and response.status_code != 400):
+            raise JiraError(f"Failed to create issues: {response.status_code} {response.text}", response.status_code)
+        data = response.json()
+        errors = {error["failedElementNumber"]: _error_message(error.get("elementErrors", dict()))
+                  for error in data.get("errors", list())}
+        created = iter(data.get("issues", list()))
+        results = []
+        for n in range(len(chunk)):
+            # Created issues are listed in the order of the request, failed ones are left out
+            issue = None if n in errors else next(created, None)
+            if issue:
+                results.append((issue["key"], None))
+            else:
+                results.append((None, errors.get(n, f"{response.status_code} {response.text}")))
+        return results
+
+    def _create_one(self, fields):
+        try:
+            return self.create_issue(fields)["key"], None
+        except Exception as e:
+            return None, str(e)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self._session.close()
+
+
+def _error_message(element_errors):
+    messages = list(element_errors.get("errorMessages", list()))
+    messages.extend(f"{name}: {message}" for name, message in element_errors.get("errors", dict()).items())
+    return ", ".join(messages) or "unknown error"
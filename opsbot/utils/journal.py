@@ -0,0 +1,53 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger()
+
+
+class Journal(object):
+    """
+    Append-only file with one JSON record per line. Records are appended with a single write and synced to disk.
+    A record that was only partially written, e.g. because the process was killed, is skipped when reading.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def append(self, records) -> int:
+        """Appends the records and returns the number of bytes written"""
+        data = b''.join(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n' for record in records)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return len(data)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def read(self):
+        if not self.exists():
+            return
+        with open(self.path, 'rb') as f:
+            for line_number, line in enumerate(f, start=1):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning(f"Skipping incomplete record in line {line_number} of journal '{self.path}'")
+
+    def rename(self, path):
+        os.replace(self.path, path)
+        return Journal(path)
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
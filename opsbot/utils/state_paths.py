@@ -0,0 +1,33 @@
+MISSING = object()
+
+
+def get_path(state, path):
+    """Returns the value at the key path in the nested dicts or MISSING if there is none"""
+    ptr = state
+    for key in path:
+        if not isinstance(ptr, dict) or key not in ptr:
+            return MISSING
+        ptr = ptr[key]
+    return ptr
+
+
+def set_path(state, path, value):
+    """Sets the value at the key path and creates the dicts on the way"""
+    ptr = state
+    for key in path[:-1]:
+        if not isinstance(ptr.get(key), dict):
+            ptr[key] = dict()
+        ptr = ptr[key]
+    ptr[path[-1]] = value
+
+
+def replace_path(state, path, value):
+    """
+    Returns a copy of the state with the value at the key path. Only the dicts on the path are copied, the given
+    state is not changed and can still be read by other threads.
+    """
+    if not path:
+        return value
+    state = dict(state) if isinstance(state, dict) else dict()
+    state[path[0]] = replace_path(state.get(path[0]), path[1:], value)
+    return state
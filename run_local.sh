@@ -1,5 +1,6 @@
 #!/bin/bash
 
 export OPSBOT_LOCAL=true
+export TEAMS_SKIP_AUTHENTICATION=true
 
 venv/bin/python -m opsbot.main
@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from .environment import prepare_environment
+
+prepare_environment()
+
+
+@pytest.fixture
+def fake_api():
+    from .fake_kubernetes import FakeCoreV1Api
+    return FakeCoreV1Api()
+
+
+@pytest.fixture
+def configmap_plugin_factory(fake_api, monkeypatch):
+    """Creates configmap persistence plugins which share the fake Kubernetes API, like replicas of the bot."""
+    from .fake_kubernetes import FakeConfigmapPersistencePlugin
+    from opsbot.config import reload_config
+
+    monkeypatch.setitem(os.environ, 'PERSISTENCE_CONFIGMAP_NAME', 'opsbot')
+    monkeypatch.setitem(os.environ, 'PERSISTENCE_CONFIGMAP_NAMESPACE', 'test')
+    reload_config()
+
+    def create():
+        return FakeConfigmapPersistencePlugin(None, fake_api)
+
+    yield create
+    monkeypatch.undo()
+    reload_config()
@@ -0,0 +1,27 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+_CONFIG = """
+teams:
+  app_id: benchmark
+  app_password: benchmark
+persistence:
+  plugin: file
+  path: {directory}/state
+"""
+
+
+def prepare_environment():
+    """
+    Creates a temporary directory with a minimal opsbot config and points OPSBOT_CONFIG_FILE to it.
+    Must be called before any opsbot module is imported. Returns the directory.
+    """
+    directory = tempfile.mkdtemp(prefix="opsbot-")
+    atexit.register(shutil.rmtree, directory, True)
+    config_file = os.path.join(directory, "opsbot_config.yaml")
+    with open(config_file, "w") as f:
+        f.write(_CONFIG.format(directory=directory))
+    os.environ["OPSBOT_CONFIG_FILE"] = config_file
+    return directory
@@ -0,0 +1,132 @@
+"""
+In-memory stand-in for the parts of the Kubernetes CoreV1Api the configmap persistence plugin uses.
+Supports resourceVersion preconditions, the 1 MiB size limit and watches, and counts the bytes sent to it.
+"""
+import json
+import threading
+import time
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+from opsbot.plugins.persistence.configmap import ConfigmapPersistencePlugin
+
+CONFIGMAP_SIZE_LIMIT = 1024 * 1024
+
+
+class FakeCoreV1Api(object):
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.bytes_received = 0
+        self.requests = 0
+        self.conflicts = 0
+        self._configmaps = dict()
+        self._resource_version = 0
+        self._events = []
+        self._changed = threading.Condition()
+
+    def _request(self, body=None):
+        self.requests += 1
+        if body is not None:
+            self.bytes_received += len(json.dumps(body, default=str))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _next_resource_version(self):
+        self._resource_version += 1
+        return str(self._resource_version)
+
+    @staticmethod
+    def _model(namespace, name, configmap):
+        return client.V1ConfigMap(metadata=client.V1ObjectMeta(name=name, namespace=namespace,
+                                                               resource_version=configmap['resource_version']),
+                                  data=dict(configmap['data']), binary_data=dict(configmap['binary_data']))
+
+    def _publish(self, event_type, model):
+        self._events.append((event_type, model))
+        self._changed.notify_all()
+
+    def read_namespaced_config_map(self, name, namespace, **kwargs):
+        self._request()
+        with self._changed:
+            if (namespace, name) not in self._configmaps:
+                raise ApiException(status=404, reason="Not Found")
+            return self._model(namespace, name, self._configmaps[(namespace, name)])
+
+    def create_namespaced_config_map(self, namespace, body, **kwargs):
+        self._request(client.ApiClient().sanitize_for_serialization(body))
+        name = body.metadata['name'] if isinstance(body.metadata, dict) else body.metadata.name
+        with self._changed:
+            if (namespace, name) in self._configmaps:
+                raise ApiException(status=409, reason="AlreadyExists")
+            configmap = dict(data=dict(body.data or dict()), binary_data=dict(body.binary_data or dict()),
+                             resource_version=self._next_resource_version())
+            self._configmaps[(namespace, name)] = configmap
+            model = self._model(namespace, name, configmap)
+            self._publish('ADDED', model)
+            return model
+
+    def patch_namespaced_config_map(self, name, namespace, body, **kwargs):
+        self._request(body)
+        with self._changed:
+            if (namespace, name) not in self._configmaps:
+                raise ApiException(status=404, reason="Not Found")
+            configmap = self._configmaps[(namespace, name)]
+            expected_version = (body.get('metadata') or dict()).get('resourceVersion')
+            if expected_version is not None and expected_version != configmap['resource_version']:
+                self.conflicts += 1
+                raise ApiException(status=409, reason="Conflict")
+            data = dict(configmap['data'])
+            binary_data = dict(configmap['binary_data'])
+            for target, changes in ((data, body.get('data')), (binary_data, body.get('binaryData'))):
+                for key, value in (changes or dict()).items():
+                    if value is None:
+                        target.pop(key, None)
+                    else:
+                        target[key] = value
+            size = sum(len(key) + len(value) for key, value in list(data.items()) + list(binary_data.items()))
+            if size > CONFIGMAP_SIZE_LIMIT:
+                raise ApiException(status=422, reason=f"ConfigMap is too long: {size} bytes")
+            configmap.update(data=data, binary_data=binary_data, resource_version=self._next_resource_version())
+            model = self._model(namespace, name, configmap)
+            self._publish('MODIFIED', model)
+            return model
+
+    def list_namespaced_config_map(self, namespace, **kwargs):
+        raise NotImplementedError("Use FakeWatch to watch configmaps")
+
+    def events_since(self, resource_version, timeout):
+        with self._changed:
+            self._changed.wait_for(lambda: self._resource_version > resource_version, timeout)
+            return [event for event in self._events if int(event[1].metadata.resource_version) > resource_version]
+
+
+class FakeWatch(object):
+
+    def __init__(self, api: FakeCoreV1Api):
+        self._api = api
+
+    def stream(self, func, namespace, field_selector=None, resource_version=None, timeout_seconds=None, **kwargs):
+        name = field_selector.split('=', 1)[1] if field_selector else None
+        last_version = int(resource_version or 0)
+        deadline = time.time() + (timeout_seconds or 60)
+        while time.time() < deadline:
+            for event_type, model in self._api.events_since(last_version, max(0.0, deadline - time.time())):
+                last_version = int(model.metadata.resource_version)
+                if model.metadata.namespace == namespace and (name is None or model.metadata.name == name):
+                    yield {'type': event_type, 'object': model}
+
+
+class FakeConfigmapPersistencePlugin(ConfigmapPersistencePlugin):
+    """Configmap plugin talking to a FakeCoreV1Api instead of a cluster."""
+
+    def __init__(self, opsbot, api: FakeCoreV1Api):
+        self._fake_api = api
+        super().__init__(opsbot)
+
+    def _create_kubernetes_client(self):
+        return self._fake_api
+
+    def _create_watch(self):
+        return FakeWatch(self._fake_api)
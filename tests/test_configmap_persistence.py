@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+from kubernetes.client.rest import ApiException
+
+from opsbot.state_manager import StateManager
+
+
+def _state():
+    return dict(bot_config=dict(user_map=dict(), conversation_channels=dict()),
+                plugins=dict(actions=dict(jira=dict(issues=[]), vacation=dict(vacations=[]))))
+
+
+def _configmap(fake_api):
+    return fake_api.read_namespaced_config_map('opsbot', 'test')
+
+
+def test_persist_writes_only_changed_shards(fake_api, configmap_plugin_factory, monkeypatch):
+    plugin = configmap_plugin_factory()
+    plugin.read_state()
+    patched = []
+    patch = fake_api.patch_namespaced_config_map
+
+    def record(name, namespace, body, **kwargs):
+        patched.append({key for key, value in body['data'].items() if value is not None})
+        return patch(name, namespace, body, **kwargs)
+
+    monkeypatch.setattr(fake_api, 'patch_namespaced_config_map', record)
+    state = _state()
+    plugin.persist_state(state)
+    assert patched == [{'bot_config.yaml', 'plugins.actions.jira.yaml', 'plugins.actions.vacation.yaml'}]
+
+    state['plugins']['actions']['jira']['issues'].append('XXX-1')
+    plugin.persist_keys(state, {('plugins', 'actions', 'jira', 'issues')})
+    assert patched[1:] == [{'plugins.actions.jira.yaml'}]
+    assert 'XXX-1' in _configmap(fake_api).data['plugins.actions.jira.yaml']
+
+    plugin.persist_keys(state, {('plugins', 'actions', 'jira', 'issues')})
+    assert len(patched) == 2
+
+    assert configmap_plugin_factory().read_state() == state
+
+
+def test_failed_write_keeps_keys_dirty(fake_api, configmap_plugin_factory, monkeypatch):
+    plugin = configmap_plugin_factory()
+    state = plugin.read_state()
+    manager = StateManager(plugin, state, debounce=60)
+    patch = fake_api.patch_namespaced_config_map
+
+    def fail(*args, **kwargs):
+        raise ApiException(status=500, reason="Internal Server Error")
+
+    monkeypatch.setattr(fake_api, 'patch_namespaced_config_map', fail)
+    manager.set(('bot_config', 'user_map'), {'alice': 'id-1'})
+    with pytest.raises(ApiException):
+        manager.flush()
+    assert manager.stats()['dirty'] == 1
+
+    monkeypatch.setattr(fake_api, 'patch_namespaced_config_map', patch)
+    manager.flush()
+    assert manager.stats()['dirty'] == 0
+    assert configmap_plugin_factory().read_state()['bot_config']['user_map'] == {'alice': 'id-1'}
+
+
+def test_scheduled_write_is_retried_after_failure(fake_api, configmap_plugin_factory, monkeypatch):
+    plugin = configmap_plugin_factory()
+    state = plugin.read_state()
+    manager = StateManager(plugin, state, debounce=0.05)
+    patch = fake_api.patch_namespaced_config_map
+    failed = threading.Event()
+
+    def fail(*args, **kwargs):
+        failed.set()
+        raise ApiException(status=500, reason="Internal Server Error")
+
+    monkeypatch.setattr(fake_api, 'patch_namespaced_config_map', fail)
+    manager.set(('bot_config', 'user_map'), {'alice': 'id-1'})
+    assert failed.wait(5)
+    monkeypatch.setattr(fake_api, 'patch_namespaced_config_map', patch)
+
+    deadline = time.monotonic() + 5
+    while manager.stats()['dirty'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert manager.stats()['dirty'] == 0
+    assert configmap_plugin_factory().read_state()['bot_config']['user_map'] == {'alice': 'id-1'}
+
+
+def _replica(configmap_plugin_factory):
+    plugin = configmap_plugin_factory()
+    manager = StateManager(plugin, plugin.read_state(), debounce=60)
+    # What TeamsBot registers with watch(), without starting the watch thread
+    plugin._watch_callback = manager.apply_remote
+    return manager
+
+
+def test_conflicting_writes_to_the_same_shard_are_merged(fake_api, configmap_plugin_factory):
+    plugin = configmap_plugin_factory()
+    plugin.read_state()
+    plugin.persist_state(_state())
+    manager_a = _replica(configmap_plugin_factory)
+    manager_b = _replica(configmap_plugin_factory)
+
+    manager_a.set(('bot_config', 'user_map'), {'alice': 'id-1'})
+    manager_a.flush()
+    manager_b.set(('bot_config', 'conversation_channels'), {'conversation-1': 'channel-1'})
+    manager_b.flush()
+
+    assert fake_api.conflicts == 1
+    assert manager_b.stats()['dirty'] == 0
+    assert manager_b.get(('bot_config', 'user_map')) == {'alice': 'id-1'}
+    bot_config = configmap_plugin_factory().read_state()['bot_config']
+    assert bot_config == dict(user_map={'alice': 'id-1'}, conversation_channels={'conversation-1': 'channel-1'})
+
+
+def test_state_can_be_read_and_changed_while_writing(fake_api, configmap_plugin_factory, monkeypatch):
+    plugin = configmap_plugin_factory()
+    manager = StateManager(plugin, plugin.read_state(), debounce=60)
+    patch = fake_api.patch_namespaced_config_map
+    writing, release = threading.Event(), threading.Event()
+
+    def slow_patch(*args, **kwargs):
+        writing.set()
+        release.wait(5)
+        return patch(*args, **kwargs)
+
+    monkeypatch.setattr(fake_api, 'patch_namespaced_config_map', slow_patch)
+    manager.set(('bot_config', 'user_map'), {'alice': 'id-1'})
+    flush = threading.Thread(target=manager.flush)
+    flush.start()
+    assert writing.wait(5)
+    manager.update(('bot_config', 'user_map'), lambda user_map: dict(user_map, bob='id-2'), dict())
+    assert manager.get(('bot_config', 'user_map')) == {'alice': 'id-1', 'bob': 'id-2'}
+    release.set()
+    flush.join(5)
+
+    assert configmap_plugin_factory().read_state()['bot_config']['user_map'] == {'alice': 'id-1'}
+    assert manager.stats()['dirty'] == 1
+    manager.flush()
+    assert configmap_plugin_factory().read_state()['bot_config']['user_map'] == {'alice': 'id-1', 'bob': 'id-2'}